@@ -9,28 +9,42 @@ except AssertionError:
     exit("Piku requires Python 3.10 or above")
 
 from importlib import import_module
+from bisect import bisect_left
 from collections import defaultdict, deque
-from fcntl import fcntl, F_SETFL, F_GETFL
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from ctypes import CDLL
+from ctypes.util import find_library
+from fcntl import fcntl, flock, F_SETFL, F_GETFL, LOCK_EX, LOCK_UN
+from fnmatch import fnmatch
 from glob import glob
-from json import loads
-from multiprocessing import cpu_count
-from os import chmod, getgid, getuid, symlink, unlink, remove, stat, listdir, environ, makedirs, O_NONBLOCK
-from os.path import abspath, basename, dirname, exists, getmtime, join, realpath, splitext, isdir
+from gzip import compress as gzip_compress
+from hashlib import sha256
+from heapq import merge
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from json import dumps, loads
+from mmap import mmap, ACCESS_READ
+from multiprocessing import cpu_count, current_process, Pool
+from multiprocessing.pool import ThreadPool
+from os import chmod, close, dup2, fstat, getgid, getuid, lstat, read, rename, replace, symlink, unlink, remove, stat, sysconf, listdir, environ, makedirs, walk, O_NONBLOCK
+from os.path import abspath, basename, dirname, exists, getsize, join, realpath, relpath, splitext, isdir, islink
 from pwd import getpwuid
 from grp import getgrgid
-from re import sub, match
+from re import compile as re_compile, error as re_error, findall, sub, match, search, IGNORECASE, MULTILINE
+from select import select
 from shlex import split as shsplit
 from shutil import copyfile, rmtree, which
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, AF_INET, AF_UNIX, SOCK_STREAM
 from stat import S_IRUSR, S_IWUSR, S_IXUSR
-from subprocess import call, check_output, Popen, STDOUT, CalledProcessError
-from sys import argv, stdin, stdout, stderr, version_info, exit, path as sys_path
-from tempfile import NamedTemporaryFile
-from time import sleep
+from struct import Struct, pack
+from subprocess import call, check_output, Popen, DEVNULL, STDOUT, CalledProcessError
+from sys import argv, executable, stdin, stdout, stderr, version_info, exit, path as sys_path
+from tempfile import NamedTemporaryFile, TemporaryDirectory
+from time import monotonic, sleep, time
 from traceback import format_exc
 from urllib.request import urlopen
 
-from click import argument, group, secho as echo, pass_context, CommandCollection
+from click import argument, group, option, secho as echo, pass_context, CommandCollection, IntRange
 
 # === Make sure we can access all system and user binaries ===
 
@@ -47,15 +61,20 @@ PIKU_BIN = join(environ['HOME'], 'bin')
 PIKU_SCRIPT = realpath(__file__)
 PIKU_PLUGIN_ROOT = abspath(join(PIKU_ROOT, "plugins"))
 APP_ROOT = abspath(join(PIKU_ROOT, "apps"))
+RELEASE_ROOT = abspath(join(PIKU_ROOT, "releases"))
 DATA_ROOT = abspath(join(PIKU_ROOT, "data"))
 ENV_ROOT = abspath(join(PIKU_ROOT, "envs"))
 GIT_ROOT = abspath(join(PIKU_ROOT, "repos"))
 LOG_ROOT = abspath(join(PIKU_ROOT, "logs"))
 NGINX_ROOT = abspath(join(PIKU_ROOT, "nginx"))
+NGINX_RELOAD = join(NGINX_ROOT, ".reload")
+NGINX_RELOAD_LOCK = join(NGINX_ROOT, ".reload.lock")
 CACHE_ROOT = abspath(join(PIKU_ROOT, "cache"))
+PACKAGE_CACHE_ROOT = abspath(join(CACHE_ROOT, ".packages"))
 UWSGI_AVAILABLE = abspath(join(PIKU_ROOT, "uwsgi-available"))
 UWSGI_ENABLED = abspath(join(PIKU_ROOT, "uwsgi-enabled"))
 UWSGI_ROOT = abspath(join(PIKU_ROOT, "uwsgi"))
+METRICS_CACHE = join(PIKU_ROOT, "METRICS")
 UWSGI_LOG_MAXSIZE = '1048576'
 ACME_ROOT = environ.get('ACME_ROOT', join(environ['HOME'], '.acme.sh'))
 ACME_WWW = abspath(join(PIKU_ROOT, "acme"))
@@ -69,35 +88,30 @@ if PIKU_BIN not in environ['PATH']:
 # pylint: disable=anomalous-backslash-in-string
 NGINX_TEMPLATE = """
 $PIKU_INTERNAL_PROXY_CACHE_PATH
-upstream $APP {
-  server $NGINX_SOCKET;
-}
-server {
-  listen              $NGINX_IPV6_ADDRESS:80;
-  listen              $NGINX_IPV4_ADDRESS:80;
-
-  location ^~ /.well-known/acme-challenge {
-    allow all;
-    root ${ACME_WWW};
-  }
-$PIKU_INTERNAL_NGINX_COMMON
+{% if PIKU_INTERNAL_NGINX_KEEPALIVE %}
+# only pass Connection on for upgrades, so that clients cannot close pooled upstream connections
+map $http_upgrade $PIKU_INTERNAL_NGINX_CONNECTION {
+  default upgrade;
+  '' '';
 }
-"""
-
-NGINX_HTTPS_ONLY_TEMPLATE = """
-$PIKU_INTERNAL_PROXY_CACHE_PATH
+{% endif %}
 upstream $APP {
-  server $NGINX_SOCKET;
+$PIKU_INTERNAL_NGINX_UPSTREAM
 }
 server {
+{% if not DISABLE_IPV6 %}
   listen              $NGINX_IPV6_ADDRESS:80;
+{% endif %}
   listen              $NGINX_IPV4_ADDRESS:80;
+{% if NGINX_HTTPS_ONLY %}
   server_name         $NGINX_SERVER_NAME;
+{% endif %}
 
   location ^~ /.well-known/acme-challenge {
     allow all;
     root ${ACME_WWW};
   }
+{% if NGINX_HTTPS_ONLY %}
 
   location / {
     return 301 https://$server_name$request_uri;
@@ -105,13 +119,16 @@ server {
 }
 
 server {
+{% endif %}
 $PIKU_INTERNAL_NGINX_COMMON
 }
 """
 # pylint: enable=anomalous-backslash-in-string
 
 NGINX_COMMON_FRAGMENT = r"""
+{% if not DISABLE_IPV6 %}
   listen              $NGINX_IPV6_ADDRESS:$NGINX_SSL;
+{% endif %}
   listen              $NGINX_IPV4_ADDRESS:$NGINX_SSL;
   $NGINX_HTTP2
   ssl_certificate     $NGINX_ROOT/$APP.crt;
@@ -142,9 +159,31 @@ NGINX_COMMON_FRAGMENT = r"""
 NGINX_PORTMAP_FRAGMENT = """
   location    / {
     $PIKU_INTERNAL_NGINX_UWSGI_SETTINGS
+{% if PIKU_INTERNAL_NGINX_MICROCACHE %}
+    # absorb bursts of reads: one request refreshes each entry while the rest get the cached copy
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache $APP;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_methods GET HEAD;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_key $scheme$host$request_uri$PIKU_INTERNAL_NGINX_CACHE_GENERATION$http_cookie;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_valid 200 301 302 $PIKU_INTERNAL_NGINX_MICROCACHE_TIME;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_bypass $http_authorization;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_no_cache $http_authorization;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_lock on;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_lock_timeout 5s;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_use_stale updating error timeout;
+    ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_background_update on;
+    add_header X-Cache $upstream_cache_status;
+    add_header X-Deployed-By Piku;
+    # access_log here replaces the inherited one, so keep logging there too
+    access_log $PIKU_INTERNAL_NGINX_ACCESS_LOG;
+    access_log $LOG_ROOT/$APP/cache.log piku_cache_$APP;
+{% endif %}
     proxy_http_version 1.1;
     proxy_set_header Upgrade $http_upgrade;
+{% if PIKU_INTERNAL_NGINX_KEEPALIVE %}
+    proxy_set_header Connection $PIKU_INTERNAL_NGINX_CONNECTION;
+{% else %}
     proxy_set_header Connection "upgrade";
+{% endif %}
     proxy_set_header Host $host;
     proxy_set_header X-Forwarded-Proto $scheme;
     proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
@@ -157,7 +196,9 @@ NGINX_PORTMAP_FRAGMENT = """
 
 NGINX_ACME_FIRSTRUN_TEMPLATE = """
 server {
+{% if not DISABLE_IPV6 %}
   listen              $NGINX_IPV6_ADDRESS:80;
+{% endif %}
   listen              $NGINX_IPV4_ADDRESS:80;
   server_name         $NGINX_SERVER_NAME;
   location ^~ /.well-known/acme-challenge {
@@ -170,36 +211,58 @@ server {
 PIKU_INTERNAL_NGINX_STATIC_MAPPING = """
   location $static_url {
       sendfile on;
-      sendfile_max_chunk 1m;
+      sendfile_max_chunk $static_sendfile_max_chunk;
       tcp_nopush on;
-      directio 8m;
+      directio $static_directio;
       aio threads;
+      open_file_cache $static_open_file_cache;
+      open_file_cache_valid $static_open_file_cache_valid;
+      open_file_cache_errors on;
       alias $static_path;
+{% if PIKU_INTERNAL_NGINX_GZIP_STATIC %}
+      gzip_static on;
+{% endif %}
+{% if PIKU_INTERNAL_NGINX_BROTLI_STATIC %}
+      brotli_static on;
+{% endif %}
       try_files $uri $uri.html $uri/ $catch_all =404;
+{% if static_immutable %}
+      # fingerprinted assets never change, so browsers need not revalidate them
+      location ~* "$PIKU_INTERNAL_NGINX_IMMUTABLE_PATTERN" {
+          add_header Cache-Control "public, max-age=$PIKU_INTERNAL_NGINX_IMMUTABLE_MAX_AGE, immutable";
+          # add_header here replaces the server-level ones
+          add_header X-Deployed-By Piku;
+          open_file_cache_valid 5m;
+      }
+{% endif %}
   }
 """
 
 PIKU_INTERNAL_PROXY_CACHE_PATH = """
-uwsgi_cache_path $cache_path levels=1:2 keys_zone=$app:20m inactive=$cache_time_expiry max_size=$cache_size use_temp_path=off;
+${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_path $cache_path levels=1:2 keys_zone=$app:$cache_keys_zone inactive=$cache_time_expiry max_size=$cache_size use_temp_path=off;
+log_format piku_cache_$APP '$msec $upstream_cache_status $status $request_time "$request_uri"';
 """
 
 PIKU_INTERNAL_NGINX_CACHE_MAPPING = """
     location ~* ^/($cache_prefixes) {
-        uwsgi_cache $APP;
-        uwsgi_cache_min_uses 1;
-        uwsgi_cache_key $host$request_uri;
-        uwsgi_cache_valid 200 304 $cache_time_content;
-        uwsgi_cache_valid 301 307 $cache_time_redirects;
-        uwsgi_cache_valid 500 502 503 504 0s;
-        uwsgi_cache_valid any $cache_time_any;
-        uwsgi_hide_header Cache-Control;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache $APP;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_min_uses 1;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_key $host$request_uri$PIKU_INTERNAL_NGINX_CACHE_GENERATION;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_valid 200 304 $cache_time_content;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_valid 301 307 $cache_time_redirects;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_valid 500 502 503 504 0s;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_cache_valid any $cache_time_any;
+        ${PIKU_INTERNAL_NGINX_PROTOCOL}_hide_header Cache-Control;
         add_header Cache-Control "public, max-age=$cache_time_control";
         add_header X-Cache $upstream_cache_status;
+        access_log $PIKU_INTERNAL_NGINX_ACCESS_LOG;
+        access_log $LOG_ROOT/$APP/cache.log piku_cache_$APP;
         $PIKU_INTERNAL_NGINX_UWSGI_SETTINGS
     }
 """
 
-PIKU_INTERNAL_NGINX_UWSGI_SETTINGS = """
+PIKU_INTERNAL_NGINX_UWSGI_SETTINGS = """{% if PIKU_INTERNAL_NGINX_UWSGI %}
+
     uwsgi_pass $APP;
     uwsgi_param QUERY_STRING $query_string;
     uwsgi_param REQUEST_METHOD $request_method;
@@ -210,12 +273,110 @@ PIKU_INTERNAL_NGINX_UWSGI_SETTINGS = """
     uwsgi_param DOCUMENT_ROOT $document_root;
     uwsgi_param SERVER_PROTOCOL $server_protocol;
     uwsgi_param X_FORWARDED_FOR $proxy_add_x_forwarded_for;
-    uwsgi_param REMOTE_ADDR $remote_addr;
+    uwsgi_param REMOTE_ADDR {% if NGINX_CLOUDFLARE_ACL %}$http_cf_connecting_ip{% else %}$remote_addr{% endif %};
     uwsgi_param REMOTE_PORT $remote_port;
     uwsgi_param SERVER_ADDR $server_addr;
     uwsgi_param SERVER_PORT $server_port;
     uwsgi_param SERVER_NAME $server_name;
-"""
+{% else %}proxy_pass http://$APP;{% endif %}"""
+
+# {% if [not] NAME %}, {% else %} and {% endif %} tags (taking the whole line when on their own), and $VAR or ${VAR}
+TEMPLATE_REGEXP = re_compile(r'^[ \t]*\{%\s*([^%\n]*?)\s*%\}[ \t]*(?:\n|\Z)|\{%\s*([^%\n]*?)\s*%\}|\$(\w+|\{([^}]*)\})', MULTILINE)
+TEMPLATE_CACHE = {}
+
+# text assets worth compressing ahead of time for gzip_static and brotli_static
+PRECOMPRESS_EXTENSIONS = ['.css', '.csv', '.htm', '.html', '.ico', '.js', '.json', '.map', '.mjs', '.svg', '.txt', '.wasm', '.webmanifest', '.xml']
+PRECOMPRESS_MIN_SIZE = 1024
+
+# content-hashed asset names as emitted by bundlers, e.g. app.3f9a1c2e.js: at least 8 hex digits mixing letters and numbers,
+# so that dates and version numbers (report-20240101.pdf) are not taken for hashes
+FINGERPRINT_PATTERN = r'[.-](?=[0-9a-f]*[0-9])(?=[0-9a-f]*[a-f])[0-9a-f]{8,}\.[a-z0-9]+$'
+
+# how much of an app's nginx cache log cache:stats reads, and the size at which it is rotated to cache.log.old
+CACHE_LOG_TAIL = 16 * 1024 * 1024
+
+# assumed memory use of a uWSGI process until one has been measured, for UWSGI_PROCESSES=auto
+UWSGI_AUTO_RSS = 128 * 1024 * 1024
+
+# uWSGI cheaper algorithms usable through UWSGI_CHEAPER_ALGO
+UWSGI_CHEAPER_ALGOS = ['spare', 'spare2', 'backlog', 'busyness']
+
+# Prometheus metrics exported by piku metrics: name -> (type, description)
+METRICS = {
+    'piku_worker_up': ('gauge', 'Whether a worker answers on its uWSGI stats socket'),
+    'piku_worker_processes': ('gauge', 'Processes in a worker, including anything it started'),
+    'piku_worker_resident_memory_bytes': ('gauge', 'Resident memory of all the processes in a worker'),
+    'piku_worker_cpu_seconds_total': ('counter', 'CPU time used by the live processes in a worker'),
+    'piku_uwsgi_listen_queue': ('gauge', 'Connections waiting to be accepted by a worker'),
+    'piku_uwsgi_listen_queue_max': ('gauge', 'Size of the listen queue of a worker'),
+    'piku_uwsgi_busy_processes': ('gauge', 'uWSGI processes busy with a request'),
+    'piku_uwsgi_requests_total': ('counter', 'Requests handled by the uWSGI processes of a worker'),
+    'piku_uwsgi_exceptions_total': ('counter', 'Exceptions raised in the uWSGI processes of a worker'),
+    'piku_uwsgi_respawns_total': ('counter', 'Times uWSGI processes or attached daemons were respawned'),
+    'piku_uwsgi_average_response_seconds': ('gauge', 'Average response time of the uWSGI processes of a worker'),
+    'piku_http_requests_total': ('counter', 'Requests in the access logs of a worker, by status class'),
+    'piku_http_request_duration_seconds': ('histogram', 'Request durations in the access logs of a worker'),
+    'piku_nginx_cache_entries': ('gauge', 'Files in the nginx cache of an app'),
+    'piku_nginx_cache_bytes': ('gauge', 'Disk space used by the nginx cache of an app'),
+    'piku_nginx_cache_unreadable': ('gauge', 'Files and folders in the nginx cache of an app that piku cannot read'),
+    'piku_metrics_collector_seconds': ('gauge', 'Time the last run of each metrics collector took'),
+}
+
+# static folder profiles: size histogram buckets, and how nginx serves each kind of folder
+STATIC_SIZE_BUCKETS = [16 * 1024, 256 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+STATIC_PROFILES = {
+    # lots of small assets: keep descriptors around, never bypass the page cache
+    'small': {'static_directio': 'off', 'static_sendfile_max_chunk': '256k', 'static_open_file_cache_valid': '2m', 'inactive': '10m'},
+    'mixed': {'static_directio': '8m', 'static_sendfile_max_chunk': '1m', 'static_open_file_cache_valid': '60s', 'inactive': '5m'},
+    # large media: read big files directly instead of evicting everything else from the page cache
+    'media': {'static_directio': '4m', 'static_sendfile_max_chunk': '2m', 'static_open_file_cache_valid': '60s', 'inactive': '60s'},
+}
+
+# package manager cache locations shared by all apps (relative to PACKAGE_CACHE_ROOT)
+PACKAGE_CACHES = {
+    'PIP_CACHE_DIR': 'pip',
+    'UV_CACHE_DIR': 'uv',
+    'POETRY_CACHE_DIR': 'poetry',
+    'NPM_CONFIG_CACHE': 'npm',
+    'YARN_CACHE_FOLDER': 'yarn',
+    'NPM_CONFIG_STORE_DIR': 'pnpm',
+    'BUNDLE_USER_CACHE': 'bundler',
+    'GOMODCACHE': 'go-mod',
+    'GOCACHE': 'go-build',
+}
+# CARGO_HOME also holds cargo's config, credentials and installed binaries, so only its downloads are linked to the 'cargo' cache
+CARGO_SHARED_FOLDERS = ['registry', 'git']
+PACKAGE_CACHE_NAMES = sorted(set(PACKAGE_CACHES.values()) | {'cargo'})
+
+# inotify(7) event masks and struct inotify_event header
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+INOTIFY_EVENT = Struct('iIII')
+
+# uWSGI log timestamps: the `log-format` one set in spawn_worker and the default request/master logger one
+LOG_TIMESTAMPS = [
+    (r"\[(\d{2}/\w{3}/\d{4}:\d{2}:\d{2}:\d{2})", "%d/%b/%Y:%H:%M:%S"),
+    (r"(\w{3} \w{3} +\d+ \d{2}:\d{2}:\d{2} \d{4})", "%a %b %d %H:%M:%S %Y"),
+]
+
+# matches the `log-format` set for wsgi and web workers in spawn_worker
+ACCESS_LOG_REGEXP = re_compile(
+    r'^(?P<addr>\S+) - (?P<user>\S+) \[(?P<time>[^\]]+)\] "(?P<method>\S+) (?P<uri>\S+) (?P<proto>[^"]*)" '
+    r'(?P<status>\d{3}) (?P<size>\d+) "(?P<referer>[^"]*)" "(?P<uagent>[^"]*)" (?P<msecs>\d+)ms')
+
+# (phase, seconds) for the deploy in progress, and the time spent in nested phases
+DEPLOY_PHASES = []
+PHASE_STACK = []
+# deploys kept in each app's DEPLOYS file
+DEPLOY_HISTORY = 100
+# pending releases checked out by this process, which only its own deploy may activate
+PREPARED_RELEASES = {}
+
+# upper bounds (in ms) of the latency histogram buckets used by `stats`
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000, 30000, 60000]
 
 CRON_REGEXP = r"^((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) ((?:(?:\*\/)?\d+)|\*) (.*)$"
 
@@ -249,6 +410,71 @@ def get_free_port(address=""):
     return port
 
 
+def probe_worker(address, protocol='http', path='/', timeout=5):
+    """Sends a GET request to a worker over HTTP or the uwsgi protocol and returns the response status, if any"""
+
+    try:
+        s = socket(AF_UNIX if isinstance(address, str) else AF_INET, SOCK_STREAM)
+        s.settimeout(timeout)
+        s.connect(address)
+        path_info, _, query = path.partition('?')
+        if protocol == 'uwsgi':
+            variables = {'REQUEST_METHOD': 'GET', 'REQUEST_URI': path, 'PATH_INFO': path_info, 'QUERY_STRING': query,
+                         'SERVER_PROTOCOL': 'HTTP/1.0', 'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost'}
+            body = b"".join(pack('<H', len(k)) + k.encode() + pack('<H', len(v)) + v.encode() for k, v in variables.items())
+            s.sendall(pack('<BHB', 0, len(body), 0) + body)
+        else:
+            s.sendall("GET {} HTTP/1.0\r\nHost: localhost\r\nUser-Agent: piku\r\n\r\n".format(path).encode())
+        response = s.recv(64)
+        s.close()
+        return int(response.split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def read_worker_stats(path, timeout=2):
+    """Reads the JSON document a uWSGI stats socket sends on connect, or None if nobody is listening"""
+
+    s = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        s.settimeout(timeout)
+        s.connect(path)
+        chunks = []
+        while True:
+            chunk = s.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return loads(b"".join(chunks).decode('utf-8', 'replace'))
+    except (OSError, ValueError):
+        return None
+    finally:
+        s.close()
+
+
+def process_rss(pid):
+    """Returns the resident memory of a process in bytes (0 if it is gone)"""
+
+    try:
+        with open('/proc/{}/statm'.format(pid), 'r') as h:
+            return int(h.read().split()[1]) * sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def emperor_running():
+    """Checks whether the uWSGI emperor is accepting connections on its socket"""
+
+    s = socket(AF_UNIX, SOCK_STREAM)
+    try:
+        s.connect(join(UWSGI_ROOT, 'uwsgi.sock'))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
 def get_boolean(value):
     """Convert a boolean-ish string to a boolean."""
 
@@ -325,6 +551,66 @@ def expandvars(buffer, env, default=None, skip_escaped=False):
     return sub(pattern, replace_var, buffer)
 
 
+def compile_template(template):
+    """Parses a template into a token tree, once per template.
+
+    Literal text is kept as strings, $VAR and ${VAR} become ('$', name, text) and
+    {% if %} blocks become ('if', name, negated, body, else_body)."""
+
+    if template in TEMPLATE_CACHE:
+        return TEMPLATE_CACHE[template]
+
+    root = []
+    stack = [(None, root)]
+    pos = 0
+    for m in TEMPLATE_REGEXP.finditer(template):
+        if m.start() > pos:
+            stack[-1][1].append(template[pos:m.start()])
+        pos = m.end()
+        if m.group(3):
+            stack[-1][1].append(('$', m.group(4) or m.group(3), m.group(0)))
+            continue
+        tag = (m.group(1) if m.group(1) is not None else m.group(2)).split()
+        if tag[:1] == ['if'] and len(tag) in [2, 3] and (len(tag) == 2 or tag[1] == 'not'):
+            block = ('if', tag[-1], len(tag) == 3, [], [])
+            stack[-1][1].append(block)
+            stack.append((block, block[3]))
+        elif tag == ['else'] and stack[-1][0] and stack[-1][1] is stack[-1][0][3]:
+            stack[-1] = (stack[-1][0], stack[-1][0][4])
+        elif tag == ['endif'] and len(stack) > 1:
+            stack.pop()
+        else:
+            raise ValueError("unexpected template tag '{}'".format(m.group(0).strip()))
+    if len(stack) > 1:
+        raise ValueError("unterminated template tag '{{% if {} %}}'".format(stack[-1][0][1]))
+    if pos < len(template):
+        root.append(template[pos:])
+    TEMPLATE_CACHE[template] = root
+    return root
+
+
+def render_template(template, env):
+    """Renders a template in a single pass, leaving unknown variables (like nginx's own) alone"""
+
+    output = []
+
+    def render(tokens):
+        for token in tokens:
+            if isinstance(token, str):
+                output.append(token)
+            elif token[0] == '$':
+                output.append(env.get(token[1], token[2]))
+            else:
+                value = env.get(token[1], False)
+                if (get_boolean(value) if isinstance(value, str) else bool(value)) != token[2]:
+                    render(token[3])
+                else:
+                    render(token[4])
+
+    render(compile_template(template))
+    return ''.join(output)
+
+
 def command_output(cmd):
     """executes a command and grabs its output, if any"""
     try:
@@ -334,29 +620,399 @@ def command_output(cmd):
         return ""
 
 
+def nginx_capabilities():
+    """Returns the version and modules of the nginx binary, as reported by `nginx -V`.
+
+    The result is cached in NGINX_ROOT/CAPABILITIES and only probed again when
+    the binary's path, inode or mtime change."""
+
+    binary, key = which('nginx'), None
+    cache = join(NGINX_ROOT, 'CAPABILITIES')
+    if binary:
+        info = stat(binary)
+        key = [realpath(binary), info.st_ino, info.st_mtime_ns]
+        try:
+            with open(cache, 'r') as h:
+                record = loads(h.read())
+            # records from older piku versions lack some of the fields
+            if record.get('key') == key and 'prefix' in record:
+                return record
+        except (OSError, ValueError):
+            pass
+
+    output = command_output("nginx -V")
+    version = search(r'nginx/(\d+(?:\.\d+)*)', output)
+    modules = findall(r'--with-(\w+?)_module', output)
+    # third party modules such as ngx_brotli are added by path
+    modules.extend(basename(m.rstrip('/')) for m in findall(r'--add-(?:dynamic-)?module=([^\s\\\'"]+)', output))
+    conf_path = search(r'--conf-path=([^\s\\\'"]+)', output)
+    log_path = search(r'--http-log-path=([^\s\\\'"]+)', output)
+    prefix = search(r'--prefix=([^\s\\\'"]+)', output)
+    record = {
+        'key': key,
+        'version': [int(x) for x in version.group(1).split('.')] if version else [0, 0, 0],
+        'modules': sorted(set(modules)),
+        'conf_path': conf_path.group(1) if conf_path else '/etc/nginx/nginx.conf',
+        'log_path': log_path.group(1) if log_path else '/var/log/nginx/access.log',
+        'prefix': prefix.group(1) if prefix else '/usr/local/nginx'
+    }
+    if key and isdir(NGINX_ROOT):
+        with open(cache, 'w') as h:
+            h.write(dumps(record))
+    return record
+
+
+def nginx_isolated_test(app, nginx_conf):
+    """Tests an app's nginx config on its own, inside a minimal main config.
+
+    Returns (True, '') if it passed, (False, errors) if the errors point at the app's config,
+    and (None, errors) if the result says nothing about the app (e.g. a variable or module
+    that only the full server config provides)."""
+
+    nginx = nginx_capabilities()
+    conf_path = nginx.get('conf_path', '/etc/nginx/nginx.conf')
+    mime_types = join(dirname(conf_path), 'mime.types')
+    # dynamic modules (e.g. ngx_brotli) are loaded by the main config, before any block
+    modules = []
+    try:
+        with open(conf_path, 'r') as h:
+            for line in h:
+                if '{' in line:
+                    break
+                found = search(r'^\s*(load_module|include)\s+([^;\s]+)\s*;', line)
+                if found:
+                    modules.append((found.group(1), join(dirname(conf_path), found.group(2)) if found.group(1) == 'include' else found.group(2)))
+    except OSError:
+        pass
+    with TemporaryDirectory(prefix='piku-nginx-') as tmp:
+        # load_module paths are relative to the prefix, which -p moves here
+        symlink(join(nginx.get('prefix', '/usr/local/nginx'), 'modules'), join(tmp, 'modules'))
+        main = join(tmp, 'nginx.conf')
+        with open(main, 'w') as h:
+            h.write("".join("{} {};\n".format(*m) for m in modules))
+            h.write("pid {0}/nginx.pid;\nerror_log {0}/error.log;\nevents {{}}\nhttp {{\n".format(tmp))
+            if exists(mime_types):
+                h.write("  include {};\n".format(mime_types))
+            for path in ['client_body', 'proxy', 'fastcgi', 'uwsgi', 'scgi']:
+                h.write("  {0}_temp_path {1}/{0};\n".format(path, tmp))
+            h.write("  include {};\n}}\n".format(nginx_conf))
+        args = ['nginx', '-t', '-q', '-p', tmp + '/', '-c', main]
+        # keep nginx from opening its compiled-in error log before reading the config
+        if tuple(nginx['version']) >= (1, 19, 5):
+            args[2:2] = ['-e', join(tmp, 'error.log')]
+        try:
+            check_output(args, stderr=STDOUT, env=environ)
+            return True, ''
+        except CalledProcessError as e:
+            errors = e.output.decode('utf-8', 'replace')
+        except OSError as e:
+            return None, str(e)
+    lines = [line for line in errors.splitlines() if '[emerg]' in line or '[error]' in line]
+    # directives from modules the main config did not let us load are only checked by the full test
+    if any('/{}.conf:'.format(app) in line and 'unknown directive' not in line for line in lines):
+        return False, "\n".join(lines)
+    return None, errors
+
+
+def nginx_config_test(app, nginx_conf, env):
+    """Validates an app's nginx config, returning the errors if it is broken.
+
+    Only the app's own config is tested unless the isolated test is inconclusive or
+    NGINX_CONFIG_TEST is `full`, so deploy time does not grow with the number of apps."""
+
+    passed, errors = nginx_isolated_test(app, nginx_conf)
+    if passed is False:
+        return errors
+    if passed is None or env.get('NGINX_CONFIG_TEST', 'isolated').lower() == 'full':
+        try:
+            return str(check_output(r"nginx -t 2>&1 | grep -E '{}\.conf:[0-9]+$'".format(app), env=environ, shell=True))
+        except Exception:
+            return None
+    return None
+
+
+@contextmanager
+def nginx_reload_queue():
+    """Locks and yields the reload queue state kept in NGINX_RELOAD_LOCK, saving any changes"""
+
+    with open(NGINX_RELOAD_LOCK, 'a+') as h:
+        flock(h, LOCK_EX)
+        try:
+            h.seek(0)
+            try:
+                state = loads(h.read())
+            except ValueError:
+                state = {}
+            for k in ['requested', 'reloads', 'saved', 'failed']:
+                state.setdefault(k, 0)
+            yield state
+            h.seek(0)
+            h.truncate()
+            h.write(dumps(state))
+        finally:
+            flock(h, LOCK_UN)
+
+
+def schedule_nginx_reload():
+    """Queues an nginx reload, so that config changes made within PIKU_NGINX_RELOAD_DELAY
+       seconds of each other (e.g. by concurrent deploys) result in a single reload"""
+
+    try:
+        delay = float(environ.get('PIKU_NGINX_RELOAD_DELAY', '2'))
+    except ValueError:
+        delay = 2
+    with nginx_reload_queue() as state:
+        state['requested'] += 1
+        # a reload is already queued and will pick up this change as well, unless its waiter died
+        if state.get('pending') and state['pending'] + 60 > time() and process_alive(state.get('waiter')):
+            state['saved'] += 1
+            echo("-----> nginx reload already queued")
+            return
+        state['pending'] = time() + delay
+        waiter = Popen([executable, PIKU_SCRIPT, 'nginx:reload', '--queued'], stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL, start_new_session=True)
+        state['waiter'] = waiter.pid
+    echo("-----> nginx reload queued")
+
+
+def process_alive(pid):
+    """Checks whether a process exists and has not exited (zombies count as gone)"""
+
+    try:
+        with open('/proc/{}/stat'.format(int(pid)), 'r') as h:
+            return h.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, TypeError, ValueError, IndexError):
+        return False
+
+
+def reload_nginx():
+    """Validates the full nginx config and reloads nginx, either directly or through piku-nginx.path"""
+
+    try:
+        check_output(['nginx', '-t', '-q'], stderr=STDOUT, env=environ)
+    except CalledProcessError as e:
+        errors = [line for line in e.output.decode('utf-8', 'replace').splitlines() if '[emerg]' in line and NGINX_ROOT in line]
+        # without root, nginx -t can also fail on logs and pid files, which are no reason to hold back
+        if errors:
+            return "\n".join(errors)
+    except OSError:
+        pass
+    try:
+        check_output(['nginx', '-s', 'reload'], stderr=STDOUT, env=environ)
+    except (CalledProcessError, OSError):
+        # nginx belongs to root, so let systemd reload it
+        with open(NGINX_RELOAD, 'w') as h:
+            h.write(datetime.now().isoformat())
+    return None
+
+
+def nginx_upstream(workers, env, uwsgi):
+    """Returns the body of an app's upstream block: balancing method, one server per web worker and keepalive"""
+
+    servers = [env['NGINX_SOCKET']]
+    if 'web' in workers and not uwsgi:
+        servers = ["{}:{}".format(env['BIND_ADDRESS'], p) for p in env['WEB_PORTS'].split(',')]
+    upstream = ["  server {};".format(s) for s in servers]
+
+    method = env.get('NGINX_UPSTREAM_METHOD', 'round_robin').strip()
+    if method.split(' ')[0] in ['least_conn', 'ip_hash', 'hash', 'random']:
+        upstream.insert(0, "  {};".format(method))
+    elif method != 'round_robin':
+        echo("Error: unsupported NGINX_UPSTREAM_METHOD '{}', using round_robin.".format(method), fg='red')
+
+    # uwsgi_pass cannot reuse connections
+    env['PIKU_INTERNAL_NGINX_KEEPALIVE'] = 'false'
+    if not uwsgi:
+        try:
+            keepalive = int(env.get('NGINX_UPSTREAM_KEEPALIVE', '32'))
+        except ValueError:
+            echo("Error: malformed setting 'NGINX_UPSTREAM_KEEPALIVE', ignoring it.", fg='red')
+            keepalive = 32
+        if keepalive > 0:
+            upstream.append("  keepalive {};".format(keepalive))
+            env['PIKU_INTERNAL_NGINX_KEEPALIVE'] = 'true'
+            # map variables are global, so escape everything but letters and digits to keep app names apart
+            env['PIKU_INTERNAL_NGINX_CONNECTION'] = '$piku_connection_' + ''.join(c if c.isalnum() else '_{:02x}'.format(ord(c)) for c in env['APP'])
+    return '\n'.join(upstream)
+
+
+def nginx_cache_settings(app, env, release):
+    """Sets the PIKU_INTERNAL_ values for the cache zone, NGINX_CACHE_PREFIXES mappings and microcaching,
+       for the release about to go live"""
+
+    env['PIKU_INTERNAL_PROXY_CACHE_PATH'] = ''
+    env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'] = ''
+    env['PIKU_INTERNAL_NGINX_ACCESS_LOG'] = nginx_capabilities().get('log_path', '/var/log/nginx/access.log')
+    rotate_cache_log(app)
+
+    # Get a mapping of /prefix1,/prefix2
+    default_cache_path = join(CACHE_ROOT, app)
+    if not exists(default_cache_path):
+        makedirs(default_cache_path)
+    try:
+        cache_size = int(env.get('NGINX_CACHE_SIZE', '1'))
+    except Exception:
+        echo("=====> Invalid cache size, defaulting to 1GB")
+        cache_size = 1
+    # nginx keeps about 8000 keys per megabyte of zone, so assume 8KB entries on average
+    cache_keys_zone = str(max(cache_size * 16, 1)) + "m"
+    cache_size = str(cache_size) + "g"
+    try:
+        cache_time_control = int(env.get('NGINX_CACHE_CONTROL', '3600'))
+    except Exception:
+        echo("=====> Invalid time for cache control, defaulting to 3600s")
+        cache_time_control = 3600
+    cache_time_control = str(cache_time_control)
+    try:
+        cache_time_content = int(env.get('NGINX_CACHE_TIME', '3600'))
+    except Exception:
+        echo("=====> Invalid cache time for content, defaulting to 3600s")
+        cache_time_content = 3600
+    cache_time_content = str(cache_time_content) + "s"
+    try:
+        cache_time_redirects = int(env.get('NGINX_CACHE_REDIRECTS', '3600'))
+    except Exception:
+        echo("=====> Invalid cache time for redirects, defaulting to 3600s")
+        cache_time_redirects = 3600
+    cache_time_redirects = str(cache_time_redirects) + "s"
+    try:
+        cache_time_any = int(env.get('NGINX_CACHE_ANY', '3600'))
+    except Exception:
+        echo("=====> Invalid cache expiry fallback, defaulting to 3600s")
+        cache_time_any = 3600
+    cache_time_any = str(cache_time_any) + "s"
+    try:
+        cache_time_expiry = int(env.get('NGINX_CACHE_EXPIRY', '86400'))
+    except Exception:
+        echo("=====> Invalid cache expiry, defaulting to 86400s")
+        cache_time_expiry = 86400
+    cache_time_expiry = str(cache_time_expiry) + "s"
+    cache_prefixes = env.get('NGINX_CACHE_PREFIXES', '')
+    cache_path = env.get('NGINX_CACHE_PATH', default_cache_path)
+    if not exists(cache_path):
+        echo("=====> Cache path {} does not exist, using default {}, be aware of disk usage.".format(cache_path, default_cache_path))
+        cache_path = default_cache_path
+    # a new release changes every cache key, so nginx stops serving anything cached before it
+    env['PIKU_INTERNAL_NGINX_CACHE_GENERATION'] = ''
+    if get_boolean(env.get('NGINX_CACHE_PURGE_ON_DEPLOY', 'false')):
+        env['PIKU_INTERNAL_NGINX_CACHE_GENERATION'] = ':' + basename(realpath(release))
+    try:
+        microcache = int(env.get('NGINX_MICROCACHE', '0'))
+    except ValueError:
+        echo("=====> Invalid microcache time, disabling it")
+        microcache = 0
+    env['PIKU_INTERNAL_NGINX_MICROCACHE'] = str(microcache > 0).lower()
+    env['PIKU_INTERNAL_NGINX_MICROCACHE_TIME'] = str(microcache) + "s"
+    if microcache > 0:
+        echo("-----> nginx will microcache GET and HEAD replies for {}s, except for authorized requests.".format(microcache))
+        env['PIKU_INTERNAL_PROXY_CACHE_PATH'] = render_template(PIKU_INTERNAL_PROXY_CACHE_PATH, {**env, **locals()})
+    if len(cache_prefixes):
+        prefixes = []  # this will turn into part of /(path1|path2|path3)
+        try:
+            items = cache_prefixes.split(',')
+            for item in items:
+                if item[0] == '/':
+                    prefixes.append(item[1:])
+                else:
+                    prefixes.append(item)
+            cache_prefixes = "|".join(prefixes)
+            echo("-----> nginx will cache /({}) prefixes up to {} or {} of disk space, with the following timings:".format(cache_prefixes, cache_time_expiry, cache_size))
+            echo("-----> nginx will cache content for {}.".format(cache_time_content))
+            echo("-----> nginx will cache redirects for {}.".format(cache_time_redirects))
+            echo("-----> nginx will cache everything else for {}.".format(cache_time_any))
+            echo("-----> nginx will send caching headers asking for {} seconds of public caching.".format(cache_time_control))
+            env['PIKU_INTERNAL_PROXY_CACHE_PATH'] = render_template(
+                PIKU_INTERNAL_PROXY_CACHE_PATH, {**env, **locals()})
+            env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'] = render_template(
+                PIKU_INTERNAL_NGINX_CACHE_MAPPING, {**env, **locals()})
+        except Exception as e:
+            echo("Error {} in cache path spec: should be /prefix1:[,/prefix2], ignoring.".format(e))
+            env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'] = ''
+
+
+def nginx_cache_path(app, env):
+    """Returns the folder nginx keeps an app's cache in"""
+
+    cache_path = env.get('NGINX_CACHE_PATH', join(CACHE_ROOT, app))
+    return cache_path if exists(cache_path) else join(CACHE_ROOT, app)
+
+
+def nginx_cache_entries(path):
+    """Returns (file, key, size) for every entry in an nginx cache folder,
+       and how many files and folders could not be read (they belong to nginx)"""
+
+    entries, denied = [], []
+    for root, _, files in walk(path, onerror=denied.append):
+        for name in files:
+            filename = join(root, name)
+            try:
+                with open(filename, 'rb') as h:
+                    header = h.read(4096)
+                    size = fstat(h.fileno()).st_size
+            except OSError:
+                denied.append(filename)
+                continue
+            # the binary header is followed by a KEY: line, then the upstream reply
+            start = header.find(b'\nKEY: ')
+            if start >= 0:
+                end = header.find(b'\n', start + 6)
+                entries.append((filename, header[start + 6:end].decode('utf-8', 'replace'), size))
+    return entries, len(denied)
+
+
+def rotate_cache_log(app):
+    """Moves an app's nginx cache log to cache.log.old once it outgrows what cache:stats reads, returning True if it did.
+       nginx keeps writing to the moved file until its next reload."""
+
+    logfile = join(LOG_ROOT, app, 'cache.log')
+    try:
+        if getsize(logfile) <= CACHE_LOG_TAIL:
+            return False
+        replace(logfile, logfile + '.old')
+    except OSError:
+        return False
+    return True
+
+
+def read_cache_log(app):
+    """Tallies the cache statuses nginx logged for an app, returning (counts, first, last)"""
+
+    counts, first, last = defaultdict(int), None, None
+    logfile = join(LOG_ROOT, app, 'cache.log')
+    # only look at recent requests, which may have started in the rotated log
+    budget = CACHE_LOG_TAIL
+    for path in [logfile, logfile + '.old']:
+        if budget <= 0 or not exists(path):
+            continue
+        budget -= getsize(path)
+        with open(path, 'rb') as h:
+            if budget < 0:
+                h.seek(-budget)
+                h.readline()
+            for line in h:
+                fields = line.decode('utf-8', 'replace').split(' ', 2)
+                try:
+                    when = float(fields[0])
+                except (ValueError, IndexError):
+                    continue
+                counts[fields[1]] += 1
+                first, last = min(first or when, when), max(last or when, when)
+    return counts, first, last
+
+
 def get_nginx_ssl_config():
     """Detect nginx version and return (ssl_listen, http2_directive) tuple.
 
     nginx >=1.25.1 uses a separate 'http2 on;' directive.
     Older versions append 'http2' to the listen line."""
-    nginx = command_output("nginx -V")
+    nginx = nginx_capabilities()
     nginx_ssl = "443 ssl"
     nginx_http2 = ""
-    if "--with-http_v2_module" in nginx:
-        nginx_version = ""
-        for part in nginx.split():
-            if part.startswith("nginx/"):
-                nginx_version = part.split("/")[1]
-                break
-        try:
-            ver_tuple = tuple(int(x) for x in nginx_version.split("."))
-        except (ValueError, AttributeError):
-            ver_tuple = (0, 0, 0)
-        if ver_tuple >= (1, 25, 1):
+    if "http_v2" in nginx['modules']:
+        if tuple(nginx['version']) >= (1, 25, 1):
             nginx_http2 = "http2 on;"
         else:
             nginx_ssl += " http2"
-    elif "--with-http_spdy_module" in nginx and "nginx/1.6.2" not in nginx:
+    elif "http_spdy" in nginx['modules'] and nginx['version'] != [1, 6, 2]:
         nginx_ssl += " spdy"
     return nginx_ssl, nginx_http2
 
@@ -398,89 +1054,580 @@ def found_app(kind):
     return True
 
 
-def do_deploy(app, deltas={}, newrev=None):
-    """Deploy an app by resetting the work directory"""
+def package_cache_env(env=None):
+    """Points package managers at the shared download cache, unless the app overrides them"""
+
+    env = env or {}
+    result = {k: env.get(k, join(PACKAGE_CACHE_ROOT, v)) for k, v in PACKAGE_CACHES.items()}
+    result['BUNDLE_GLOBAL_GEM_CACHE'] = env.get('BUNDLE_GLOBAL_GEM_CACHE', 'true')
+    return result
+
+
+def remove_readonly(function, path, _):
+    """Error handler for rmtree (onexc or onerror) that makes read-only folders (such as Go's module cache) writable and tries again"""
+
+    chmod(dirname(path), 0o700)
+    function(path)
+
+
+def share_cargo_cache():
+    """Links the download folders of the piku user's CARGO_HOME to the shared package cache, leaving existing ones alone"""
+
+    cargo_home = environ.get('CARGO_HOME', join(environ['HOME'], '.cargo'))
+    for name in CARGO_SHARED_FOLDERS:
+        shared, local = join(PACKAGE_CACHE_ROOT, 'cargo', name), join(cargo_home, name)
+        # gone after cache:prune empties the 'cargo' cache, which would leave the links dangling
+        if not exists(shared):
+            makedirs(shared)
+        if not exists(local) and not islink(local):
+            if not exists(cargo_home):
+                makedirs(cargo_home)
+            symlink(shared, local)
+
+
+def parse_size(value):
+    """Parses a size like '512M' or '10G' into bytes"""
+
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    value = value.strip().upper().rstrip('B')
+    if value[-1:] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def human_size(value):
+    """Formats a byte count for display"""
+
+    for unit in ['B', 'K', 'M', 'G']:
+        if value < 1024:
+            return "{:.1f}{}".format(value, unit) if unit != 'B' else "{}B".format(value)
+        value /= 1024.0
+    return "{:.1f}T".format(value)
+
+
+def scan_tree(path):
+    """Returns (path, size, atime) for every file under a folder"""
+
+    result = []
+    for root, dirs, files in walk(path):
+        for f in files:
+            try:
+                info = lstat(join(root, f))
+            except OSError:
+                continue
+            result.append((join(root, f), info.st_size, info.st_atime))
+    return result
+
+
+def dependency_fingerprint(app, filenames, extra=()):
+    """Hashes the contents of an app's dependency files (and any extra settings that affect installs)"""
+
+    digest = sha256()
+    for f in filenames:
+        path = join(release_path(app), f)
+        if exists(path):
+            digest.update(f.encode('utf-8') + b'\0')
+            with open(path, 'rb') as h:
+                digest.update(h.read())
+    for x in extra:
+        digest.update(b'\0' + str(x).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def dependencies_changed(app, kind, filenames, extra=()):
+    """Checks dependency inputs against the last successful install, returns (changed, fingerprint)"""
+
+    fingerprint = dependency_fingerprint(app, filenames, extra)
+    recorded = parse_settings(join(ENV_ROOT, app, 'DEPENDENCIES'), {})
+    return recorded.get(kind) != fingerprint, fingerprint
+
+
+def record_dependencies(app, kind, fingerprint):
+    """Remembers the dependency fingerprint of a successful install"""
+
+    deps_file = join(ENV_ROOT, app, 'DEPENDENCIES')
+    recorded = parse_settings(deps_file, {})
+    recorded[kind] = fingerprint
+    write_config(deps_file, recorded)
+
+
+def release_path(app):
+    """Returns the folder an app is being built in: the release this process prepared, if any, or the live one"""
+
+    return PREPARED_RELEASES.get(app) or join(APP_ROOT, app)
+
+
+@contextmanager
+def release_lock(app):
+    """Serializes deploys and rollbacks of an app, so that none of them builds in or discards another's release"""
+
+    releases = join(RELEASE_ROOT, app)
+    if not exists(releases):
+        makedirs(releases)
+    with open(join(releases, 'LOCK'), 'a') as h:
+        flock(h, LOCK_EX)
+        try:
+            yield
+        finally:
+            flock(h, LOCK_UN)
+
+
+def release_history(app):
+    """Returns the names of an app's releases, in the order they were activated"""
+
+    history = join(RELEASE_ROOT, app, 'HISTORY')
+    if not exists(history):
+        return []
+    with open(history, 'r') as h:
+        return [line.strip() for line in h if line.strip()]
+
+
+def prepare_release(app, newrev):
+    """Checks out a revision into a release folder next to the live one, to be activated by spawn_app"""
 
     app_path = join(APP_ROOT, app)
-    procfile = join(app_path, 'Procfile')
-    log_path = join(LOG_ROOT, app)
+    releases = join(RELEASE_ROOT, app)
+    pending = join(releases, 'next')
+    target = join(releases, newrev[:12])
+
+    if not exists(releases):
+        makedirs(releases)
+
+    # Move checkouts made by older piku versions into a release of their own
+    if isdir(app_path) and not islink(app_path):
+        try:
+            rev = check_output(['git', 'rev-parse', 'HEAD'], cwd=app_path).decode('utf-8').strip()[:12]
+        except (CalledProcessError, OSError):
+            rev = 'initial'
+        legacy = join(releases, rev)
+        echo("-----> Moving '{}' to release '{}'".format(app, basename(legacy)), fg='green')
+        rename(app_path, legacy)
+        activate_release(app, legacy)
+
+    # Discard leftovers from a deploy that never went live
+    if islink(pending):
+        stale = realpath(pending)
+        unlink(pending)
+        if exists(stale) and stale != realpath(app_path):
+            rmtree(stale)
+
+    live = realpath(app_path) if exists(app_path) else None
+    if live != target:
+        if exists(target):
+            rmtree(target)
+        if live:
+            # start from the live tree so untracked build artifacts allow incremental builds
+            echo("-----> Preparing release '{}'".format(basename(target)), fg='green')
+            retval = call(['cp', '-a', '--reflink=auto', live, target])
+        else:
+            retval = call(['git', 'clone', '--quiet', join(GIT_ROOT, app), target])
+        if retval:
+            echo("Error: could not create release '{}' for app '{}'.".format(basename(target), app), fg='red')
+            if exists(target):
+                rmtree(target)
+            exit(retval)
+
+    env = {'GIT_WORK_DIR': target}
+    call(['git', 'fetch', '--quiet'], cwd=target, env=env)
+    retval = call(['git', 'reset', '--quiet', '--hard', newrev], cwd=target, env=env)
+    if retval:
+        echo("Error: could not check out revision '{}' for app '{}'.".format(newrev, app), fg='red')
+        if live != target:
+            rmtree(target)
+        exit(retval)
+    call(['git', 'submodule', 'init'], cwd=target, env=env)
+    call(['git', 'submodule', 'update'], cwd=target, env=env)
+    if live != target:
+        symlink(target, pending)
+        PREPARED_RELEASES[app] = target
+
+
+def activate_release(app, target=None):
+    """Atomically points the live app folder at a release (the pending one by default)"""
+
+    releases = join(RELEASE_ROOT, app)
+    pending = join(releases, 'next')
+    if target is None:
+        if not islink(pending):
+            return
+        target = realpath(pending)
+
+    swap = join(APP_ROOT, '.{}.swap'.format(app))
+    if islink(swap):
+        unlink(swap)
+    symlink(target, swap)
+    replace(swap, join(APP_ROOT, app))
+    if islink(pending):
+        unlink(pending)
+    echo("-----> Activated release '{}'".format(basename(target)), fg='green')
+
+    history = release_history(app)
+    if not history or history[-1] != basename(target):
+        history.append(basename(target))
+
+    # Keep the most recent releases around for rollbacks
+    settings = parse_settings(join(APP_ROOT, app, 'ENV'), {})
+    settings.update(parse_settings(join(ENV_ROOT, app, 'ENV'), {}))
+    try:
+        keep = max(int(settings.get('PIKU_KEEP_RELEASES', '5')), 1)
+    except ValueError:
+        keep = 5
+    kept = []
+    for name in reversed(history):
+        if name not in kept and len(kept) < keep:
+            kept.append(name)
+    for name in listdir(releases):
+        path = join(releases, name)
+        if isdir(path) and not islink(path) and name not in kept:
+            echo("-----> Removing old release '{}'".format(name))
+            rmtree(path)
+    with open(join(releases, 'HISTORY'), 'w') as h:
+        h.write("".join("{}\n".format(name) for name in history if name in kept))
+
+
+@contextmanager
+def deploy_phase(name):
+    """Times a deploy phase (also usable as a decorator), excluding time spent in phases nested within it"""
+
+    PHASE_STACK.append(0)
+    start = monotonic()
+    try:
+        yield
+    finally:
+        elapsed = monotonic() - start
+        DEPLOY_PHASES.append((name, round(elapsed - PHASE_STACK.pop(), 3)))
+        if PHASE_STACK:
+            PHASE_STACK[-1] += elapsed
+
+
+@contextmanager
+def deploy_record(app, newrev=None):
+    """Collects the phases of a deploy and appends them as a JSON record to LOG_ROOT/<app>/DEPLOYS"""
+
+    DEPLOY_PHASES.clear()
+    started, start, status = datetime.now(), monotonic(), 0
+    try:
+        yield
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+        raise
+    except Exception:
+        status = 1
+        raise
+    finally:
+        history = join(LOG_ROOT, app, 'DEPLOYS')
+        if isdir(dirname(history)) and DEPLOY_PHASES:
+            record = {
+                'time': started.isoformat(timespec='seconds'),
+                'release': basename(realpath(release_path(app))),
+                'rev': newrev,
+                'status': status,
+                'total': round(monotonic() - start, 3),
+                'phases': DEPLOY_PHASES[:]
+            }
+            lines = read_deploy_history(app)[-(DEPLOY_HISTORY - 1):] + [record]
+            with open(history, 'w') as h:
+                h.write(''.join(dumps(r) + '\n' for r in lines))
+
+
+def read_deploy_history(app):
+    """Returns the recorded deploys of an app, oldest first"""
+
+    history = join(LOG_ROOT, app, 'DEPLOYS')
+    records = []
+    if exists(history):
+        with open(history, 'r') as h:
+            for line in h:
+                try:
+                    records.append(loads(line))
+                except ValueError:
+                    pass
+    return records
+
+
+def nginx_static_settings(env):
+    """Sets the PIKU_INTERNAL_ values PIKU_INTERNAL_NGINX_STATIC_MAPPING uses, and returns whether to precompress assets"""
+
+    modules = nginx_capabilities()['modules']
+    precompress = get_boolean(env.get('NGINX_STATIC_PRECOMPRESS', 'true'))
+    # .gz files are always written, and would never be served without gzip_static
+    if precompress and 'http_gzip_static' not in modules:
+        echo("-----> nginx was built without gzip_static, not precompressing static files")
+        precompress = False
+    env['PIKU_INTERNAL_NGINX_GZIP_STATIC'] = str(precompress).lower()
+    env['PIKU_INTERNAL_NGINX_BROTLI_STATIC'] = str(precompress and 'ngx_brotli' in modules and brotli_available()).lower()
 
-    env = {'GIT_WORK_DIR': app_path}
-    if exists(app_path):
-        echo("-----> Deploying app '{}'".format(app), fg='green')
-        call('git fetch --quiet', cwd=app_path, env=env, shell=True)
+    env['PIKU_INTERNAL_NGINX_IMMUTABLE_PATTERN'] = env.get('NGINX_STATIC_IMMUTABLE_PATTERN', FINGERPRINT_PATTERN)
+    try:
+        env['PIKU_INTERNAL_NGINX_IMMUTABLE_MAX_AGE'] = str(int(env.get('NGINX_STATIC_IMMUTABLE_MAX_AGE', '31536000')))
+    except ValueError:
+        echo("Error: malformed setting 'NGINX_STATIC_IMMUTABLE_MAX_AGE', ignoring it.", fg='red')
+        env['PIKU_INTERNAL_NGINX_IMMUTABLE_MAX_AGE'] = '31536000'
+    return precompress
+
+
+def index_static_folder(folder, env):
+    """Profiles a static folder (file count and size histogram) to pick how nginx should serve it,
+       and looks for fingerprinted assets that can be marked as immutable.
+       Returns the values PIKU_INTERNAL_NGINX_STATIC_MAPPING needs for it."""
+
+    files = [(path, size) for path, size, _ in scan_tree(folder) if not islink(path)]
+    histogram = [[0, 0] for _ in range(len(STATIC_SIZE_BUCKETS) + 1)]
+    for _, size in files:
+        bucket = histogram[bisect_left(STATIC_SIZE_BUCKETS, size)]
+        bucket[0], bucket[1] = bucket[0] + 1, bucket[1] + size
+    total = sum(size for _, size in files)
+
+    # files of a megabyte or more making up most of the bytes means media, mostly small files means assets
+    profile = env.get('NGINX_STATIC_PROFILE', 'auto').lower()
+    if profile not in STATIC_PROFILES:
+        if profile != 'auto':
+            echo("Error: unknown NGINX_STATIC_PROFILE '{}', picking one automatically.".format(profile), fg='red')
+        if total and sum(b[1] for b in histogram[3:]) >= total / 2:
+            profile = 'media'
+        elif files and sum(b[0] for b in histogram[:2]) >= len(files) * 0.9:
+            profile = 'small'
+        else:
+            profile = 'mixed'
+    values = dict(STATIC_PROFILES[profile])
+    values['static_open_file_cache'] = 'max={} inactive={}'.format(min(max(len(files) * 2, 1000), 65536), values.pop('inactive'))
+    for key in ['directio', 'sendfile_max_chunk', 'open_file_cache']:
+        values['static_' + key] = env.get('NGINX_STATIC_' + key.upper(), values['static_' + key])
+    echo("-----> nginx will serve {} as '{}' ({} files, {}, {}% under 256K): directio {static_directio}, sendfile_max_chunk {static_sendfile_max_chunk}, open_file_cache {static_open_file_cache}".format(
+        folder, profile, len(files), human_size(total), int(100 * sum(b[0] for b in histogram[:2]) / len(files)) if files else 0, **values))
+
+    values['static_immutable'] = False
+    if get_boolean(env.get('NGINX_STATIC_IMMUTABLE', 'true')):
+        try:
+            pattern = re_compile(env['PIKU_INTERNAL_NGINX_IMMUTABLE_PATTERN'], IGNORECASE)
+            count = len([path for path, _ in files if pattern.search(basename(path))])
+            if count:
+                echo("-----> nginx will serve {} fingerprinted files in {} as immutable".format(count, folder))
+            values['static_immutable'] = count > 0
+        except re_error as e:
+            echo("Error: malformed setting 'NGINX_STATIC_IMMUTABLE_PATTERN' ({}), ignoring it.".format(e), fg='red')
+    return values
+
+
+def brotli_available():
+    """Checks for a brotli encoder, either the Python module or the command line tool"""
+
+    try:
+        import_module('brotli')
+        return True
+    except ImportError:
+        return which('brotli') is not None
+
+
+def compress_static_file(job):
+    """Writes the .gz (and .br) siblings of a static file, for use in a process pool.
+       Returns the file's size and the sizes written, or None if it could not be read or written."""
+
+    path, brotli = job
+    try:
+        with open(path, 'rb') as h:
+            data = h.read()
+        outputs = {'.gz': lambda: gzip_compress(data, 9, mtime=0)}
+        if brotli:
+            try:
+                encoder = import_module('brotli')
+                outputs['.br'] = lambda: encoder.compress(data, quality=11)
+            except ImportError:
+                outputs['.br'] = lambda: check_output(['brotli', '-c', '-q', '11', path])
+        sizes = {}
+        for suffix, compress in outputs.items():
+            compressed = compress()
+            # not worth it unless nginx gets to send noticeably less
+            if len(compressed) < len(data) * 0.95:
+                with open(path + suffix + '.tmp', 'wb') as h:
+                    h.write(compressed)
+                replace(path + suffix + '.tmp', path + suffix)
+                sizes[suffix] = len(compressed)
+            elif exists(path + suffix):
+                remove(path + suffix)
+        return len(data), sizes
+    except (OSError, CalledProcessError):
+        return None
+
+
+@deploy_phase('precompress')
+def precompress_static(app, base, paths, brotli=False):
+    """Precompresses the text assets under an app's static paths in parallel, skipping files unchanged since the last deploy.
+       Files are tracked relative to base, so that each release picks up where the previous one left off."""
+
+    state_file = join(ENV_ROOT, app, 'PRECOMPRESSED')
+    try:
+        with open(state_file, 'r') as h:
+            previous = loads(h.read())
+    except (OSError, ValueError):
+        previous = {}
+    suffixes = ['.gz', '.br'] if brotli else ['.gz']
+
+    current, jobs = {}, []
+    for folder in paths:
+        for path, size, _ in scan_tree(folder):
+            if splitext(path)[1].lower() not in PRECOMPRESS_EXTENSIONS or size < PRECOMPRESS_MIN_SIZE or islink(path):
+                continue
+            try:
+                with open(path, 'rb') as h:
+                    digest = sha256(h.read()).hexdigest()
+            except OSError:
+                echo("Warning: could not read '{}', not precompressing it".format(path), fg='yellow')
+                continue
+            key = relpath(path, base)
+            # only the encodings that were worth keeping have siblings, and releases are copied from the previous one
+            last = previous.get(key)
+            if isinstance(last, dict) and last['hash'] == digest and last['tried'] == suffixes and all(exists(path + x) for x in last['kept']):
+                current[key] = last
+            else:
+                current[key] = {'hash': digest, 'tried': suffixes, 'kept': []}
+                jobs.append((path, brotli))
+
+    # siblings of files that are gone would be served in their place
+    for key in set(previous) - set(current):
+        for suffix in ['.gz', '.br']:
+            if exists(join(base, key) + suffix):
+                remove(join(base, key) + suffix)
+
+    before, after = 0, 0
+    if jobs:
+        echo("-----> precompressing {} of {} static files".format(len(jobs), len(current)))
+        # no pool if we are part of one already (e.g. deploy:all), since its processes cannot have children
+        if current_process().daemon or len(jobs) == 1:
+            results = list(map(compress_static_file, jobs))
+        else:
+            with Pool(min(cpu_count(), len(jobs))) as pool:
+                results = pool.map(compress_static_file, jobs, chunksize=max(1, len(jobs) // (cpu_count() * 4)))
+        for (path, _), result in zip(jobs, results):
+            if result is None:
+                echo("Warning: could not precompress '{}'".format(path), fg='yellow')
+                del current[relpath(path, base)]
+                continue
+            current[relpath(path, base)]['kept'] = sorted(result[1])
+            before, after = before + result[0], after + result[1].get('.gz', result[0])
+        echo("-----> precompressed static files: {} down to {} with gzip".format(human_size(before), human_size(after)), fg='green')
+
+    with open(state_file, 'w') as h:
+        h.write(dumps(current))
+
+
+def do_deploy(app, deltas={}, newrev=None):
+    """Deploy an app, checking out new revisions into a release folder that spawn_app activates"""
+
+    with release_lock(app), deploy_record(app, newrev):
         if newrev:
-            call('git reset --hard {}'.format(newrev), cwd=app_path, env=env, shell=True)
-        call('git submodule init', cwd=app_path, env=env, shell=True)
-        call('git submodule update', cwd=app_path, env=env, shell=True)
-        if not exists(log_path):
-            makedirs(log_path)
-        workers = parse_procfile(procfile)
-        if workers and len(workers) > 0:
-            settings = {}
-            if "preflight" in workers:
-                echo("-----> Running preflight.", fg='green')
-                retval = call(workers["preflight"], cwd=app_path, env=settings, shell=True)
-                if retval:
-                    echo("-----> Exiting due to preflight command error value: {}".format(retval))
-                    exit(retval)
-                workers.pop("preflight", None)
-            if exists(join(app_path, 'requirements.txt')) and found_app("Python"):
-                settings.update(deploy_python(app, deltas))
-            elif exists(join(app_path, 'pyproject.toml')) and which('poetry') and found_app("Python"):
-                settings.update(deploy_python_with_poetry(app, deltas))
-            elif exists(join(app_path, 'pyproject.toml')) and which('uv') and found_app("Python (uv)"):
-                settings.update(deploy_python_with_uv(app, deltas))
-            elif exists(join(app_path, 'Gemfile')) and found_app("Ruby Application") and check_requirements(['ruby', 'gem', 'bundle']):
-                settings.update(deploy_ruby(app, deltas))
-            elif exists(join(app_path, 'package.json')) and found_app("Node") and (
-                    check_requirements(['nodejs', 'npm']) or check_requirements(['node', 'npm']) or check_requirements(['nodeenv'])):
-                settings.update(deploy_node(app, deltas))
-            elif exists(join(app_path, 'pom.xml')) and found_app("Java Maven") and check_requirements(['java', 'mvn']):
-                settings.update(deploy_java_maven(app, deltas))
-            elif exists(join(app_path, 'build.gradle')) and found_app("Java Gradle") and check_requirements(['java', 'gradle']):
-                settings.update(deploy_java_gradle(app, deltas))
-            elif (exists(join(app_path, 'Godeps')) or exists(join(app_path, 'go.mod')) or len(glob(join(app_path, '*.go')))) and found_app("Go") and check_requirements(['go']):
-                settings.update(deploy_go(app, deltas))
-            elif exists(join(app_path, 'deps.edn')) and found_app("Clojure CLI") and check_requirements(['java', 'clojure']):
-                settings.update(deploy_clojure_cli(app, deltas))
-            elif exists(join(app_path, 'project.clj')) and found_app("Clojure Lein") and check_requirements(['java', 'lein']):
-                settings.update(deploy_clojure_leiningen(app, deltas))
-            elif 'php' in workers:
-                if check_requirements(['uwsgi_php']):
-                    echo("-----> PHP app detected.", fg='green')
+            with deploy_phase('prepare'):
+                prepare_release(app, newrev)
+        app_path = release_path(app)
+        procfile = join(app_path, 'Procfile')
+        log_path = join(LOG_ROOT, app)
+
+        env = {'GIT_WORK_DIR': app_path}
+        if exists(app_path):
+            echo("-----> Deploying app '{}'".format(app), fg='green')
+            if not newrev:
+                with deploy_phase('git fetch'):
+                    call('git fetch --quiet', cwd=app_path, env=env, shell=True)
+                with deploy_phase('submodules'):
+                    call('git submodule init', cwd=app_path, env=env, shell=True)
+                    call('git submodule update', cwd=app_path, env=env, shell=True)
+            if not exists(log_path):
+                makedirs(log_path)
+            workers = parse_procfile(procfile)
+            if workers and len(workers) > 0:
+                settings = {}
+                if "preflight" in workers:
+                    echo("-----> Running preflight.", fg='green')
+                    with deploy_phase('preflight'):
+                        retval = call(workers["preflight"], cwd=app_path, env=settings, shell=True)
+                    if retval:
+                        echo("-----> Exiting due to preflight command error value: {}".format(retval))
+                        exit(retval)
+                    workers.pop("preflight", None)
+                if exists(join(app_path, 'requirements.txt')) and found_app("Python"):
+                    settings.update(deploy_python(app, deltas))
+                elif exists(join(app_path, 'pyproject.toml')) and which('poetry') and found_app("Python"):
+                    settings.update(deploy_python_with_poetry(app, deltas))
+                elif exists(join(app_path, 'pyproject.toml')) and which('uv') and found_app("Python (uv)"):
+                    settings.update(deploy_python_with_uv(app, deltas))
+                elif exists(join(app_path, 'Gemfile')) and found_app("Ruby Application") and check_requirements(['ruby', 'gem', 'bundle']):
+                    settings.update(deploy_ruby(app, deltas))
+                elif exists(join(app_path, 'package.json')) and found_app("Node") and (
+                        check_requirements(['nodejs', 'npm']) or check_requirements(['node', 'npm']) or check_requirements(['nodeenv'])):
+                    settings.update(deploy_node(app, deltas))
+                elif exists(join(app_path, 'pom.xml')) and found_app("Java Maven") and check_requirements(['java', 'mvn']):
+                    settings.update(deploy_java_maven(app, deltas))
+                elif exists(join(app_path, 'build.gradle')) and found_app("Java Gradle") and check_requirements(['java', 'gradle']):
+                    settings.update(deploy_java_gradle(app, deltas))
+                elif (exists(join(app_path, 'Godeps')) or exists(join(app_path, 'go.mod')) or len(glob(join(app_path, '*.go')))) and found_app("Go") and check_requirements(['go']):
+                    settings.update(deploy_go(app, deltas))
+                elif exists(join(app_path, 'deps.edn')) and found_app("Clojure CLI") and check_requirements(['java', 'clojure']):
+                    settings.update(deploy_clojure_cli(app, deltas))
+                elif exists(join(app_path, 'project.clj')) and found_app("Clojure Lein") and check_requirements(['java', 'lein']):
+                    settings.update(deploy_clojure_leiningen(app, deltas))
+                elif 'php' in workers:
+                    if check_requirements(['uwsgi_php']):
+                        echo("-----> PHP app detected.", fg='green')
+                        settings.update(deploy_identity(app, deltas))
+                    else:
+                        echo("-----> PHP app detected but uwsgi-plugin-php was not found", fg='red')
+                elif exists(join(app_path, 'Cargo.toml')) and exists(join(app_path, 'rust-toolchain.toml')) and found_app("Rust") and check_requirements(['rustc', 'cargo']):
+                    settings.update(deploy_rust(app, deltas))
+                elif 'release' in workers and 'web' in workers:
+                    echo("-----> Generic app detected.", fg='green')
+                    settings.update(deploy_identity(app, deltas))
+                elif 'static' in workers:
+                    echo("-----> Static app detected.", fg='green')
                     settings.update(deploy_identity(app, deltas))
                 else:
-                    echo("-----> PHP app detected but uwsgi-plugin-php was not found", fg='red')
-            elif exists(join(app_path, 'Cargo.toml')) and exists(join(app_path, 'rust-toolchain.toml')) and found_app("Rust") and check_requirements(['rustc', 'cargo']):
-                settings.update(deploy_rust(app, deltas))
-            elif 'release' in workers and 'web' in workers:
-                echo("-----> Generic app detected.", fg='green')
-                settings.update(deploy_identity(app, deltas))
-            elif 'static' in workers:
-                echo("-----> Static app detected.", fg='green')
-                settings.update(deploy_identity(app, deltas))
+                    echo("-----> Could not detect runtime!", fg='red')
+                # TODO: detect other runtimes
+                if "release" in workers:
+                    echo("-----> Releasing", fg='green')
+                    with deploy_phase('release'):
+                        retval = call(workers["release"], cwd=app_path, env=settings, shell=True)
+                    if retval:
+                        echo("-----> Exiting due to release command error value: {}".format(retval))
+                        exit(retval)
+                    workers.pop("release", None)
             else:
-                echo("-----> Could not detect runtime!", fg='red')
-            # TODO: detect other runtimes
-            if "release" in workers:
-                echo("-----> Releasing", fg='green')
-                retval = call(workers["release"], cwd=app_path, env=settings, shell=True)
-                if retval:
-                    echo("-----> Exiting due to release command error value: {}".format(retval))
-                    exit(retval)
-                workers.pop("release", None)
+                echo("Error: Invalid Procfile for app '{}'.".format(app), fg='red')
+            if app in PREPARED_RELEASES:
+                echo("Warning: release '{}' was not activated.".format(basename(app_path)), fg='yellow')
         else:
-            echo("Error: Invalid Procfile for app '{}'.".format(app), fg='red')
-    else:
-        echo("Error: app '{}' not found.".format(app), fg='red')
+            echo("Error: app '{}' not found.".format(app), fg='red')
+
 
+def deploy_logged(app):
+    """Deploys an app with all output going to LOG_ROOT/<app>/deploy.log, for use in a process pool"""
 
+    logfile = join(LOG_ROOT, app, 'deploy.log')
+    makedirs(dirname(logfile), exist_ok=True)
+    start, status = time(), 0
+    with open(logfile, 'w') as h:
+        stdout.flush()
+        stderr.flush()
+        # redirect the descriptors themselves so that build tools are captured as well
+        dup2(h.fileno(), 1)
+        dup2(h.fileno(), 2)
+        try:
+            do_deploy(app)
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception as e:
+            echo("Error: {}: {}".format(type(e).__name__, e), fg='red')
+            status = 1
+        stdout.flush()
+        stderr.flush()
+    return app, status, time() - start, logfile
+
+
+@deploy_phase('build:gradle')
 def deploy_java_gradle(app, deltas={}):
     """Deploy a Java application using Gradle"""
     java_path = join(ENV_ROOT, app)
-    build_path = join(APP_ROOT, app, 'build')
-    env_file = join(APP_ROOT, app, 'ENV')
+    build_path = join(release_path(app), 'build')
+    env_file = join(release_path(app), 'ENV')
 
     env = {
         'VIRTUAL_ENV': java_path,
@@ -493,25 +1640,31 @@ def deploy_java_gradle(app, deltas={}):
     if not exists(java_path):
         makedirs(java_path)
 
+    changed, fingerprint = dependencies_changed(app, 'gradle', ['build.gradle', 'build.gradle.kts', 'settings.gradle', 'settings.gradle.kts', 'gradle.properties', 'gradle.lockfile'])
     if not exists(build_path):
         echo("-----> Building Java Application")
-        call('gradle build', cwd=join(APP_ROOT, app), env=env, shell=True)
-
-    else:
+        retval = call('gradle build', cwd=release_path(app), env=env, shell=True)
+    elif changed:
         echo("-----> Removing previous builds")
         echo("-----> Rebuilding Java Application")
-        call('gradle clean build', cwd=join(APP_ROOT, app), env=env, shell=True)
+        retval = call('gradle clean build', cwd=release_path(app), env=env, shell=True)
+    else:
+        echo("-----> Dependencies unchanged, rebuilding Java Application incrementally")
+        retval = call('gradle build', cwd=release_path(app), env=env, shell=True)
+    if not retval:
+        record_dependencies(app, 'gradle', fingerprint)
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:maven')
 def deploy_java_maven(app, deltas={}):
     """Deploy a Java application using Maven"""
     # TODO: Use jenv to isolate Java Application environments
 
     java_path = join(ENV_ROOT, app)
-    target_path = join(APP_ROOT, app, 'target')
-    env_file = join(APP_ROOT, app, 'ENV')
+    target_path = join(release_path(app), 'target')
+    env_file = join(release_path(app), 'ENV')
 
     env = {
         'VIRTUAL_ENV': java_path,
@@ -524,24 +1677,30 @@ def deploy_java_maven(app, deltas={}):
     if not exists(java_path):
         makedirs(java_path)
 
+    changed, fingerprint = dependencies_changed(app, 'maven', ['pom.xml'])
     if not exists(target_path):
         echo("-----> Building Java Application")
-        call('mvn package', cwd=join(APP_ROOT, app), env=env, shell=True)
-
-    else:
+        retval = call('mvn package', cwd=release_path(app), env=env, shell=True)
+    elif changed:
         echo("-----> Removing previous builds")
         echo("-----> Rebuilding Java Application")
-        call('mvn clean package', cwd=join(APP_ROOT, app), env=env, shell=True)
+        retval = call('mvn clean package', cwd=release_path(app), env=env, shell=True)
+    else:
+        echo("-----> Dependencies unchanged, rebuilding Java Application incrementally")
+        retval = call('mvn package', cwd=release_path(app), env=env, shell=True)
+    if not retval:
+        record_dependencies(app, 'maven', fingerprint)
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:clojure')
 def deploy_clojure_cli(app, deltas={}):
     """Deploy a Clojure Application"""
 
     virtual = join(ENV_ROOT, app)
-    target_path = join(APP_ROOT, app, 'target')
-    env_file = join(APP_ROOT, app, 'ENV')
+    target_path = join(release_path(app), 'target')
+    env_file = join(release_path(app), 'ENV')
 
     if not exists(target_path):
         makedirs(virtual)
@@ -553,17 +1712,18 @@ def deploy_clojure_cli(app, deltas={}):
     if exists(env_file):
         env.update(parse_settings(env_file, env))
     echo("-----> Building Clojure Application")
-    call('clojure -T:build release', cwd=join(APP_ROOT, app), env=env, shell=True)
+    call('clojure -T:build release', cwd=release_path(app), env=env, shell=True)
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:leiningen')
 def deploy_clojure_leiningen(app, deltas={}):
     """Deploy a Clojure Application"""
 
     virtual = join(ENV_ROOT, app)
-    target_path = join(APP_ROOT, app, 'target')
-    env_file = join(APP_ROOT, app, 'ENV')
+    target_path = join(release_path(app), 'target')
+    env_file = join(release_path(app), 'ENV')
 
     if not exists(target_path):
         makedirs(virtual)
@@ -575,17 +1735,21 @@ def deploy_clojure_leiningen(app, deltas={}):
     if exists(env_file):
         env.update(parse_settings(env_file, env))
     echo("-----> Building Clojure Application")
-    call('lein clean', cwd=join(APP_ROOT, app), env=env, shell=True)
-    call('lein uberjar', cwd=join(APP_ROOT, app), env=env, shell=True)
+    changed, fingerprint = dependencies_changed(app, 'leiningen', ['project.clj'])
+    if changed:
+        call('lein clean', cwd=release_path(app), env=env, shell=True)
+    if not call('lein uberjar', cwd=release_path(app), env=env, shell=True):
+        record_dependencies(app, 'leiningen', fingerprint)
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:ruby')
 def deploy_ruby(app, deltas={}):
     """Deploy a Ruby Application"""
 
     virtual = join(ENV_ROOT, app)
-    env_file = join(APP_ROOT, app, 'ENV')
+    env_file = join(release_path(app), 'ENV')
 
     env = {
         'VIRTUAL_ENV': virtual,
@@ -593,25 +1757,32 @@ def deploy_ruby(app, deltas={}):
     }
     if exists(env_file):
         env.update(parse_settings(env_file, env))
+    env.update(package_cache_env(env))
 
     if not exists(virtual):
         echo("-----> Building Ruby Application")
         makedirs(virtual)
-        call('bundle config set --local path $VIRTUAL_ENV', cwd=join(APP_ROOT, app), env=env, shell=True)
+        call('bundle config set --local path $VIRTUAL_ENV', cwd=release_path(app), env=env, shell=True)
     else:
         echo("------> Rebuilding Ruby Application")
 
-    call('bundle install', cwd=join(APP_ROOT, app), env=env, shell=True)
+    changed, fingerprint = dependencies_changed(app, 'ruby', ['Gemfile', 'Gemfile.lock', '.ruby-version'])
+    if changed:
+        if not call('bundle install', cwd=release_path(app), env=env, shell=True):
+            record_dependencies(app, 'ruby', fingerprint)
+    else:
+        echo("-----> Gemfile unchanged, skipping bundle install")
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:go')
 def deploy_go(app, deltas={}):
     """Deploy a Go application"""
 
     go_path = join(ENV_ROOT, app)
-    deps = join(APP_ROOT, app, 'Godeps')
-    go_mod = join(APP_ROOT, app, 'go.mod')
+    deps = join(release_path(app), 'Godeps')
+    go_mod = join(release_path(app), 'go.mod')
 
     first_time = False
     if not exists(go_path):
@@ -622,41 +1793,52 @@ def deploy_go(app, deltas={}):
         first_time = True
 
     if exists(deps):
-        if first_time or getmtime(deps) > getmtime(go_path):
+        changed, fingerprint = dependencies_changed(app, 'godep', ['Godeps/Godeps.json'])
+        if first_time or changed:
             echo("-----> Running godep for '{}'".format(app), fg='green')
             env = {
                 'GOPATH': '$HOME/gopath',
                 'GOROOT': '$HOME/go',
                 'PATH': '$PATH:$HOME/go/bin',
-                'GO15VENDOREXPERIMENT': '1'
+                'GO15VENDOREXPERIMENT': '1',
+                **package_cache_env()
             }
-            call('godep update ...', cwd=join(APP_ROOT, app), env=env, shell=True)
+            if not call('godep update ...', cwd=release_path(app), env=env, shell=True):
+                record_dependencies(app, 'godep', fingerprint)
 
     if exists(go_mod):
-        echo("-----> Running go mod tidy for '{}'".format(app), fg='green')
-        call('go mod tidy', cwd=join(APP_ROOT, app), shell=True)
+        changed, fingerprint = dependencies_changed(app, 'go', ['go.mod', 'go.sum'])
+        if first_time or changed:
+            echo("-----> Running go mod tidy for '{}'".format(app), fg='green')
+            if not call('go mod tidy', cwd=release_path(app), env={**environ, **package_cache_env()}, shell=True):
+                record_dependencies(app, 'go', fingerprint)
+        else:
+            echo("-----> go.mod unchanged, skipping go mod tidy")
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:rust')
 def deploy_rust(app, deltas={}):
     """Deploy a Rust application"""
 
-    app_path = join(APP_ROOT, app)
+    app_path = release_path(app)
     echo("-----> Running cargo build for '{}'".format(app), fg='green')
-    call('cargo build', cwd=app_path, shell=True)
+    share_cargo_cache()
+    call('cargo build', cwd=app_path, env={**environ, **package_cache_env()}, shell=True)
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:node')
 def deploy_node(app, deltas={}):
     """Deploy a Node application"""
 
     virtualenv_path = join(ENV_ROOT, app)
     node_path = join(ENV_ROOT, app, "node_modules")
-    node_modules_symlink = join(APP_ROOT, app, "node_modules")
+    node_modules_symlink = join(release_path(app), "node_modules")
     npm_prefix = abspath(join(node_path, ".."))
-    env_file = join(APP_ROOT, app, 'ENV')
-    deps = join(APP_ROOT, app, 'package.json')
+    env_file = join(release_path(app), 'ENV')
+    deps = join(release_path(app), 'package.json')
 
     first_time = False
     if not exists(node_path):
@@ -672,6 +1854,7 @@ def deploy_node(app, deltas={}):
     }
     if exists(env_file):
         env.update(parse_settings(env_file, env))
+    env.update(package_cache_env(env))
 
     package_manager_command = env.get("NODE_PACKAGE_MANAGER", "npm --package-lock=false")
     package_manager = package_manager_command.split(" ")[0]
@@ -682,7 +1865,7 @@ def deploy_node(app, deltas={}):
     version = env.get("NODE_VERSION")
     node_binary = join(virtualenv_path, "bin", "node")
     try:
-        installed = check_output("{} -v".format(node_binary), cwd=join(APP_ROOT, app), env=env, shell=True).decode("utf8").rstrip(
+        installed = check_output("{} -v".format(node_binary), cwd=release_path(app), env=env, shell=True).decode("utf8").rstrip(
             "\n") if exists(node_binary) else ""
     except CalledProcessError:
         installed = ""
@@ -706,24 +1889,30 @@ def deploy_node(app, deltas={}):
             pass
 
     if exists(deps) and check_requirements(['npm']):
-        if first_time or getmtime(deps) > getmtime(node_path):
-            copyfile(join(APP_ROOT, app, 'package.json'), join(ENV_ROOT, app, 'package.json'))
+        changed, fingerprint = dependencies_changed(app, 'node', ['package.json', 'package-lock.json', 'npm-shrinkwrap.json', 'yarn.lock', 'pnpm-lock.yaml'],
+                                                    [version, package_manager_command])
+        if first_time or changed:
+            copyfile(join(release_path(app), 'package.json'), join(ENV_ROOT, app, 'package.json'))
             if not exists(node_modules_symlink):
                 symlink(node_path, node_modules_symlink)
             if package_manager != "npm":
                 echo("-----> Installing package manager {} with npm".format(package_manager))
-                call("npm install -g {}".format(package_manager), cwd=join(APP_ROOT, app), env=env, shell=True)
+                call("npm install -g {}".format(package_manager), cwd=release_path(app), env=env, shell=True)
             echo("-----> Running {} for '{}'".format(package_manager_command, app), fg='green')
-            call('{} install --prefix {}'.format(package_manager_command, npm_prefix), cwd=join(APP_ROOT, app), env=env, shell=True)
+            if not call('{} install --prefix {}'.format(package_manager_command, npm_prefix), cwd=release_path(app), env=env, shell=True):
+                record_dependencies(app, 'node', fingerprint)
+        else:
+            echo("-----> package.json unchanged, skipping {} install".format(package_manager))
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:python')
 def deploy_python(app, deltas={}):
     """Deploy a Python application"""
 
     virtualenv_path = join(ENV_ROOT, app)
-    requirements = join(APP_ROOT, app, 'requirements.txt')
-    env_file = join(APP_ROOT, app, 'ENV')
+    requirements = join(release_path(app), 'requirements.txt')
+    env_file = join(release_path(app), 'ENV')
     # Set unbuffered output and readable UTF-8 mapping
     env = {
         'PYTHONUNBUFFERED': '1',
@@ -748,20 +1937,24 @@ def deploy_python(app, deltas={}):
     activation_script = join(virtualenv_path, 'bin', 'activate_this.py')
     exec(open(activation_script).read(), dict(__file__=activation_script))
 
-    if first_time or getmtime(requirements) > getmtime(virtualenv_path):
+    changed, fingerprint = dependencies_changed(app, 'python', ['requirements.txt'], [version])
+    if first_time or changed:
         echo("-----> Running pip for '{}'".format(app), fg='green')
-        call('pip install -r {}'.format(requirements), cwd=virtualenv_path, shell=True)
+        if not call('pip install -r {}'.format(requirements), cwd=virtualenv_path, env={**environ, **package_cache_env(env)}, shell=True):
+            record_dependencies(app, 'python', fingerprint)
+    else:
+        echo("-----> requirements.txt unchanged, skipping pip")
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:poetry')
 def deploy_python_with_poetry(app, deltas={}):
     """Deploy a Python application using Poetry"""
 
     echo("=====> Starting EXPERIMENTAL poetry deployment for '{}'".format(app), fg='red')
     virtualenv_path = join(ENV_ROOT, app)
-    requirements = join(APP_ROOT, app, 'pyproject.toml')
-    env_file = join(APP_ROOT, app, 'ENV')
-    symlink_path = join(APP_ROOT, app, '.venv')
+    env_file = join(release_path(app), 'ENV')
+    symlink_path = join(release_path(app), '.venv')
     if not exists(symlink_path):
         echo("-----> Creating .venv symlink '{}'".format(app), fg='green')
         symlink(virtualenv_path, symlink_path, target_is_directory=True)
@@ -774,6 +1967,7 @@ def deploy_python_with_poetry(app, deltas={}):
     }
     if exists(env_file):
         env.update(parse_settings(env_file, env))
+    env.update(package_cache_env(env))
 
     first_time = False
     if not exists(join(virtualenv_path, "bin", "activate")):
@@ -784,18 +1978,23 @@ def deploy_python_with_poetry(app, deltas={}):
             echo("-----> Env dir already exists: '{}'".format(app), fg='yellow')
         first_time = True
 
-    if first_time or getmtime(requirements) > getmtime(virtualenv_path):
+    changed, fingerprint = dependencies_changed(app, 'poetry', ['pyproject.toml', 'poetry.lock'], [env.get('PYTHON_VERSION', '')])
+    if first_time or changed:
         echo("-----> Running poetry for '{}'".format(app), fg='green')
-        call('poetry install', cwd=join(APP_ROOT, app), env=env, shell=True)
+        if not call('poetry install', cwd=release_path(app), env=env, shell=True):
+            record_dependencies(app, 'poetry', fingerprint)
+    else:
+        echo("-----> pyproject.toml unchanged, skipping poetry install")
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:uv')
 def deploy_python_with_uv(app, deltas={}):
     """Deploy a Python application using Astral uv"""
 
     echo("=====> Starting EXPERIMENTAL uv deployment for '{}'".format(app), fg='yellow')
-    env_file = join(APP_ROOT, app, 'ENV')
+    env_file = join(release_path(app), 'ENV')
     virtualenv_path = join(ENV_ROOT, app)
 
     # Create virtualenv directory if needed
@@ -813,16 +2012,12 @@ def deploy_python_with_uv(app, deltas={}):
     }
     if exists(env_file):
         env.update(parse_settings(env_file, env))
-
-    # Remove uv.lock if it exists — it may conflict with incoming commits
-    uv_lockfile = join(APP_ROOT, app, 'uv.lock')
-    if exists(uv_lockfile):
-        remove(uv_lockfile)
+    env.update(package_cache_env(env))
 
     # Build uv sync command with Python version support
     # Priority: PYTHON_VERSION env var > .python-version file
     python_version = env.get("PYTHON_VERSION", "")
-    python_version_file = join(APP_ROOT, app, '.python-version')
+    python_version_file = join(release_path(app), '.python-version')
     if not python_version and exists(python_version_file):
         with open(python_version_file, 'r') as f:
             python_version = f.read().strip()
@@ -832,12 +2027,23 @@ def deploy_python_with_uv(app, deltas={}):
         uv_cmd += ' --python {}'.format(python_version)
         echo("-----> Using Python version: {}".format(python_version), fg='green')
 
-    echo("-----> Running {}".format(uv_cmd), fg='green')
-    call(uv_cmd, cwd=join(APP_ROOT, app), env=env, shell=True)
+    # uv.lock is removed and regenerated by every sync, so it cannot tell whether anything changed
+    changed, fingerprint = dependencies_changed(app, 'uv', ['pyproject.toml'], [python_version])
+    if changed or not exists(join(virtualenv_path, 'bin', 'python')):
+        # Remove uv.lock if it exists — it may conflict with incoming commits
+        uv_lockfile = join(release_path(app), 'uv.lock')
+        if exists(uv_lockfile):
+            remove(uv_lockfile)
+        echo("-----> Running {}".format(uv_cmd), fg='green')
+        if not call(uv_cmd, cwd=release_path(app), env=env, shell=True):
+            record_dependencies(app, 'uv', fingerprint)
+    else:
+        echo("-----> pyproject.toml unchanged, skipping uv sync")
 
     return spawn_app(app, deltas)
 
 
+@deploy_phase('build:identity')
 def deploy_identity(app, deltas={}):
     env_path = join(ENV_ROOT, app)
     if not exists(env_path):
@@ -845,12 +2051,20 @@ def deploy_identity(app, deltas={}):
     return spawn_app(app, deltas)
 
 
+@deploy_phase('spawn')
 def spawn_app(app, deltas={}):
     """Create all workers for an app"""
 
     # pylint: disable=unused-variable
+    previous_release = realpath(join(APP_ROOT, app)) if exists(join(APP_ROOT, app)) else None
     app_path = join(APP_ROOT, app)
-    procfile = join(app_path, 'Procfile')
+    # a release prepared by this deploy is read in place, and only goes live once its static files are ready;
+    # anything else (e.g. config:set while a push is building) leaves it alone
+    pending = join(RELEASE_ROOT, app, 'next')
+    source_path = app_path
+    if islink(pending) and realpath(pending) == PREPARED_RELEASES.get(app):
+        source_path = PREPARED_RELEASES.pop(app)
+    procfile = join(source_path, 'Procfile')
     workers = parse_procfile(procfile)
     workers.pop("preflight", None)
     workers.pop("release", None)
@@ -860,13 +2074,16 @@ def spawn_app(app, deltas={}):
     # the Python virtualenv
     virtualenv_path = join(ENV_ROOT, app)
     # Settings shipped with the app
-    env_file = join(APP_ROOT, app, 'ENV')
+    env_file = join(source_path, 'ENV')
     # Custom overrides
     settings = join(ENV_ROOT, app, 'ENV')
     # Live settings
     live = join(ENV_ROOT, app, 'LIVE_ENV')
     # Scaling
     scaling = join(ENV_ROOT, app, 'SCALING')
+    previous = parse_procfile(scaling) or {}
+    # Current state, restored if new workers fail their health check
+    snapshot = snapshot_app(app, set(workers) | set(previous))
 
     # Bootstrap environment
     env = {
@@ -876,7 +2093,7 @@ def spawn_app(app, deltas={}):
         'HOME': environ['HOME'],
         'USER': environ['USER'],
         'PATH': ':'.join([join(virtualenv_path, 'bin'), environ['PATH']]),
-        'PWD': dirname(env_file),
+        'PWD': app_path,
         'VIRTUAL_ENV': virtualenv_path,
     }
 
@@ -901,10 +2118,29 @@ def spawn_app(app, deltas={}):
         env.update(parse_settings(settings, env))  # lgtm [py/modification-of-default-value]
 
     if 'web' in workers or 'wsgi' in workers or 'jwsgi' in workers or 'static' in workers or 'rwsgi' in workers or 'php' in workers:
-        # Pick a port if none defined
-        if 'PORT' not in env:
-            env['PORT'] = str(get_free_port())
-            echo("-----> picking free port {PORT}".format(**env))
+        # Pick a port if none defined, keeping the ones running workers listen on,
+        # since nginx is reloaded with them before those workers are restarted
+        fixed_port = 'PORT' in env
+        live_settings = {} if fixed_port else parse_settings(live, {})
+        if not fixed_port:
+            env['PORT'] = live_settings.get('PORT') or str(get_free_port())
+            echo("-----> {} port {}".format('keeping' if live_settings.get('PORT') else 'picking free', env['PORT']))
+
+        # each web worker needs a port of its own so that nginx can balance between them
+        if 'web' in workers:
+            ports = [int(env['PORT'])]
+            live_ports = [int(p) for p in live_settings.get('WEB_PORTS', '').split(',') if p.isdigit()]
+            for i in range(1, int(previous.get('web', 1)) + deltas.get('web', 0)):
+                if i < len(live_ports):
+                    port = live_ports[i]
+                else:
+                    port = ports[-1] + 1 if fixed_port else get_free_port()
+                while port in ports:
+                    port = get_free_port()
+                ports.append(port)
+            env['WEB_PORTS'] = ','.join(map(str, ports))
+            if len(ports) > 1:
+                echo("-----> web workers will listen on ports {WEB_PORTS}".format(**env))
 
         if get_boolean(env.get('DISABLE_IPV6', 'false')):
             safe_defaults.pop('NGINX_IPV6_ADDRESS', None)
@@ -932,17 +2168,20 @@ def spawn_app(app, deltas={}):
                 'ACME_WWW': ACME_WWW,
             })
 
-            # default to reverse proxying to the TCP port we picked
-            env['PIKU_INTERNAL_NGINX_UWSGI_SETTINGS'] = 'proxy_pass http://{BIND_ADDRESS:s}:{PORT:s};'.format(**env)
-            if 'wsgi' in workers or 'jwsgi' in workers:
+            # talk uwsgi to wsgi workers, and default to reverse proxying to the TCP port we picked
+            uwsgi = 'wsgi' in workers or 'jwsgi' in workers
+            env['PIKU_INTERNAL_NGINX_UWSGI'] = str(uwsgi).lower()
+            env['PIKU_INTERNAL_NGINX_PROTOCOL'] = 'uwsgi' if uwsgi else 'proxy'
+            env['PIKU_INTERNAL_NGINX_UWSGI_SETTINGS'] = render_template(PIKU_INTERNAL_NGINX_UWSGI_SETTINGS, env)
+            if uwsgi:
                 sock = join(NGINX_ROOT, "{}.sock".format(app))
-                env['PIKU_INTERNAL_NGINX_UWSGI_SETTINGS'] = expandvars(PIKU_INTERNAL_NGINX_UWSGI_SETTINGS, env)
                 env['NGINX_SOCKET'] = env['BIND_ADDRESS'] = "unix://" + sock
                 if 'PORT' in env:
                     del env['PORT']
             else:
                 env['NGINX_SOCKET'] = "{BIND_ADDRESS:s}:{PORT:s}".format(**env)
                 echo("-----> nginx will look for app '{}' on {}".format(app, env['NGINX_SOCKET']))
+            env['PIKU_INTERNAL_NGINX_UPSTREAM'] = nginx_upstream(workers, env, uwsgi)
 
             domains = env['NGINX_SERVER_NAME'].split()
             domain = domains[0]
@@ -956,15 +2195,18 @@ def spawn_app(app, deltas={}):
                 # create a basic conf stub just to serve the acme auth
                 if not exists(nginx_conf):
                     echo("-----> writing temporary nginx conf")
-                    buffer = expandvars(NGINX_ACME_FIRSTRUN_TEMPLATE, env)
+                    buffer = render_template(NGINX_ACME_FIRSTRUN_TEMPLATE, env)
                     with open(nginx_conf, "w") as h:
                         h.write(buffer)
+                    # the challenge has to be served right away
+                    reload_nginx()
                 if not exists(key) or not exists(issuefile):
                     echo("-----> getting letsencrypt certificate")
                     certlist = " ".join(["-d {}".format(d) for d in domains])
-                    call('{acme:s}/acme.sh --issue {certlist:s} -w {www:s} --server {root_ca:s}'.format(**locals()), shell=True)
-                    call('{acme:s}/acme.sh --install-cert {certlist:s} --key-file {key:s} --fullchain-file {crt:s}'.format(
-                        **locals()), shell=True)
+                    with deploy_phase('acme'):
+                        call('{acme:s}/acme.sh --issue {certlist:s} -w {www:s} --server {root_ca:s}'.format(**locals()), shell=True)
+                        call('{acme:s}/acme.sh --install-cert {certlist:s} --key-file {key:s} --fullchain-file {crt:s}'.format(
+                            **locals()), shell=True)
                     if exists(join(ACME_ROOT, domain)) and not exists(join(ACME_WWW, app)):
                         symlink(join(ACME_ROOT, domain), join(ACME_WWW, app))
                     try:
@@ -1006,80 +2248,10 @@ def spawn_app(app, deltas={}):
 
             env['PIKU_INTERNAL_NGINX_BLOCK_GIT'] = "" if env.get('NGINX_ALLOW_GIT_FOLDERS') else r"location ~ /\.git { deny all; }"
 
-            env['PIKU_INTERNAL_PROXY_CACHE_PATH'] = ''
-            env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'] = ''
-
-            # Get a mapping of /prefix1,/prefix2
-            default_cache_path = join(CACHE_ROOT, app)
-            if not exists(default_cache_path):
-                makedirs(default_cache_path)
-            try:
-                cache_size = int(env.get('NGINX_CACHE_SIZE', '1'))
-            except Exception:
-                echo("=====> Invalid cache size, defaulting to 1GB")
-                cache_size = 1
-            cache_size = str(cache_size) + "g"
-            try:
-                cache_time_control = int(env.get('NGINX_CACHE_CONTROL', '3600'))
-            except Exception:
-                echo("=====> Invalid time for cache control, defaulting to 3600s")
-                cache_time_control = 3600
-            cache_time_control = str(cache_time_control)
-            try:
-                cache_time_content = int(env.get('NGINX_CACHE_TIME', '3600'))
-            except Exception:
-                echo("=====> Invalid cache time for content, defaulting to 3600s")
-                cache_time_content = 3600
-            cache_time_content = str(cache_time_content) + "s"
-            try:
-                cache_time_redirects = int(env.get('NGINX_CACHE_REDIRECTS', '3600'))
-            except Exception:
-                echo("=====> Invalid cache time for redirects, defaulting to 3600s")
-                cache_time_redirects = 3600
-            cache_time_redirects = str(cache_time_redirects) + "s"
-            try:
-                cache_time_any = int(env.get('NGINX_CACHE_ANY', '3600'))
-            except Exception:
-                echo("=====> Invalid cache expiry fallback, defaulting to 3600s")
-                cache_time_any = 3600
-            cache_time_any = str(cache_time_any) + "s"
-            try:
-                cache_time_expiry = int(env.get('NGINX_CACHE_EXPIRY', '86400'))
-            except Exception:
-                echo("=====> Invalid cache expiry, defaulting to 86400s")
-                cache_time_expiry = 86400
-            cache_time_expiry = str(cache_time_expiry) + "s"
-            cache_prefixes = env.get('NGINX_CACHE_PREFIXES', '')
-            cache_path = env.get('NGINX_CACHE_PATH', default_cache_path)
-            if not exists(cache_path):
-                echo("=====> Cache path {} does not exist, using default {}, be aware of disk usage.".format(cache_path, default_cache_path))
-                cache_path = env.get(default_cache_path)
-            if len(cache_prefixes):
-                prefixes = []  # this will turn into part of /(path1|path2|path3)
-                try:
-                    items = cache_prefixes.split(',')
-                    for item in items:
-                        if item[0] == '/':
-                            prefixes.append(item[1:])
-                        else:
-                            prefixes.append(item)
-                    cache_prefixes = "|".join(prefixes)
-                    echo("-----> nginx will cache /({}) prefixes up to {} or {} of disk space, with the following timings:".format(cache_prefixes, cache_time_expiry, cache_size))
-                    echo("-----> nginx will cache content for {}.".format(cache_time_content))
-                    echo("-----> nginx will cache redirects for {}.".format(cache_time_redirects))
-                    echo("-----> nginx will cache everything else for {}.".format(cache_time_any))
-                    echo("-----> nginx will send caching headers asking for {} seconds of public caching.".format(cache_time_control))
-                    env['PIKU_INTERNAL_PROXY_CACHE_PATH'] = expandvars(
-                        PIKU_INTERNAL_PROXY_CACHE_PATH, locals())
-                    env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'] = expandvars(
-                        PIKU_INTERNAL_NGINX_CACHE_MAPPING, locals())
-                    env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'] = expandvars(
-                        env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'], env)
-                except Exception as e:
-                    echo("Error {} in cache path spec: should be /prefix1:[,/prefix2], ignoring.".format(e))
-                    env['PIKU_INTERNAL_NGINX_CACHE_MAPPINGS'] = ''
+            nginx_cache_settings(app, env, source_path)
 
-            env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] = ''
+            static_mappings, static_folders = [], []
+            precompress = nginx_static_settings(env)
 
             # Get a mapping of /prefix1:path1,/prefix2:path2
             static_paths = env.get('NGINX_STATIC_PATHS', '')
@@ -1094,54 +2266,52 @@ def spawn_app(app, deltas={}):
                     items = static_paths.split(',')
                     for item in items:
                         static_url, static_path = item.split(':')
+                        static_source = static_path
                         if static_path[0] != '/':
+                            static_source = join(source_path, static_path).rstrip("/") + "/"
                             static_path = join(app_path, static_path).rstrip("/") + "/"
                         echo("-----> nginx will map {} to {}.".format(static_url, static_path))
-                        env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] = env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] + expandvars(
-                            PIKU_INTERNAL_NGINX_STATIC_MAPPING, locals())
+                        static_profile = index_static_folder(static_source, env)
+                        static_mappings.append(render_template(PIKU_INTERNAL_NGINX_STATIC_MAPPING, {**env, **locals(), **static_profile}))
+                        static_folders.append(static_source)
                 except Exception as e:
                     echo("Error {} in static path spec: should be /prefix1:path1[,/prefix2:path2], ignoring.".format(e))
-                    env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] = ''
-
-            env['PIKU_INTERNAL_NGINX_CUSTOM_CLAUSES'] = expandvars(open(join(app_path, env["NGINX_INCLUDE_FILE"])).read(), env) if env.get("NGINX_INCLUDE_FILE") else ""
+                    static_mappings, static_folders = [], []
+            env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] = ''.join(static_mappings)
+            precompress_static(app, source_path, static_folders if precompress else [], get_boolean(env['PIKU_INTERNAL_NGINX_BROTLI_STATIC']))
+
+            env['PIKU_INTERNAL_NGINX_CUSTOM_CLAUSES'] = ""
+            if env.get("NGINX_INCLUDE_FILE"):
+                with open(join(source_path, env["NGINX_INCLUDE_FILE"])) as h:
+                    custom = expandvars(h.read(), env)
+                # change any unecessary uWSGI specific directives to standard proxy ones
+                env['PIKU_INTERNAL_NGINX_CUSTOM_CLAUSES'] = custom if uwsgi else custom.replace("uwsgi_", "proxy_")
             env['PIKU_INTERNAL_NGINX_PORTMAP'] = ""
             if 'web' in workers or 'wsgi' in workers or 'jwsgi' in workers or 'rwsgi' in workers or 'php' in workers:
-                env['PIKU_INTERNAL_NGINX_PORTMAP'] = expandvars(NGINX_PORTMAP_FRAGMENT, env)
-            env['PIKU_INTERNAL_NGINX_COMMON'] = expandvars(NGINX_COMMON_FRAGMENT, env)
+                env['PIKU_INTERNAL_NGINX_PORTMAP'] = render_template(NGINX_PORTMAP_FRAGMENT, env)
+            env['PIKU_INTERNAL_NGINX_COMMON'] = render_template(NGINX_COMMON_FRAGMENT, env)
 
             echo("-----> nginx will map app '{}' to hostname(s) '{}'".format(app, env['NGINX_SERVER_NAME']))
             if get_boolean(env.get('NGINX_HTTPS_ONLY', 'false')):
-                buffer = expandvars(NGINX_HTTPS_ONLY_TEMPLATE, env)
                 echo("-----> nginx will redirect all requests to hostname(s) '{}' to HTTPS".format(env['NGINX_SERVER_NAME']))
-            else:
-                buffer = expandvars(NGINX_TEMPLATE, env)
-
-            # remove all references to IPv6 listeners (for enviroments where it's disabled)
-            if get_boolean(env.get('DISABLE_IPV6', 'false')):
-                buffer = '\n'.join([line for line in buffer.split('\n') if 'NGINX_IPV6' not in line])
-            # change any unecessary uWSGI specific directives to standard proxy ones
-            if 'wsgi' not in workers and 'jwsgi' not in workers:
-                buffer = buffer.replace("uwsgi_", "proxy_")
-
-            # map Cloudflare connecting IP to REMOTE_ADDR
-            if get_boolean(env.get('NGINX_CLOUDFLARE_ACL', 'false')):
-                buffer = buffer.replace("REMOTE_ADDR $remote_addr", "REMOTE_ADDR $http_cf_connecting_ip")
+            buffer = render_template(NGINX_TEMPLATE, env)
 
             with open(nginx_conf, "w") as h:
                 h.write(buffer)
             # prevent broken config from breaking other deploys
-            try:
-                nginx_config_test = str(check_output(r"nginx -t 2>&1 | grep -E '{}\.conf:[0-9]+$'".format(app), env=environ, shell=True))
-            except Exception:
-                nginx_config_test = None
-            if nginx_config_test:
-                echo("Error: [nginx config] {}".format(nginx_config_test), fg='red')
+            with deploy_phase('nginx -t'):
+                nginx_errors = nginx_config_test(app, nginx_conf, env)
+            if nginx_errors:
+                echo("Error: [nginx config] {}".format(nginx_errors), fg='red')
                 echo("Warning: removing broken nginx config.", fg='yellow')
                 unlink(nginx_conf)
+            schedule_nginx_reload()
+
+    if source_path != app_path:
+        activate_release(app, source_path)
 
     # Configured worker count
-    if exists(scaling):
-        worker_count.update({k: int(v) for k, v in parse_procfile(scaling).items() if k in workers})
+    worker_count.update({k: int(v) for k, v in previous.items() if k in workers})
 
     to_create = {}
     to_destroy = {}
@@ -1162,20 +2332,40 @@ def spawn_app(app, deltas={}):
     write_config(live, env)
     write_config(scaling, worker_count, ':')
 
-    if get_boolean(env.get('PIKU_AUTO_RESTART', 'true')):
-        config = glob(join(UWSGI_ENABLED, '{}*.ini'.format(app)))
-        if len(config):
-            echo("-----> Removing uwsgi configs to trigger auto-restart.")
-            for c in config:
-                remove(c)
-
-    # Create new workers
-    for k, v in to_create.items():
-        for w in v:
-            enabled = join(UWSGI_ENABLED, '{app:s}_{k:s}.{w:d}.ini'.format(**locals()))
-            if not exists(enabled):
-                echo("-----> spawning '{app:s}:{k:s}.{w:d}'".format(**locals()), fg='green')
-                spawn_worker(app, k, workers[k], env, w)
+    # Create new workers, and restart running ones if required
+    with deploy_phase('workers'):
+        gated = 'PIKU_HEALTHCHECK_PATH' in env and emperor_running()
+        spawned = {}
+        running = []
+        for k, v in to_create.items():
+            for w in v:
+                enabled = join(UWSGI_ENABLED, '{app:s}_{k:s}.{w:d}.ini'.format(**locals()))
+                if not exists(enabled):
+                    echo("-----> spawning '{app:s}:{k:s}.{w:d}'".format(**locals()), fg='green')
+                    spawned[k, w] = pidfile_mtime(app, k, w)
+                    spawn_worker(app, k, workers[k], env, w)
+                elif get_boolean(env.get('PIKU_AUTO_RESTART', 'true')):
+                    running.append((k, w))
+        failed, restarted = restart_workers(app, workers, env, running, gated)
+
+        # Make sure the new workers actually serve requests before leaving them in place
+        if gated and not failed:
+            try:
+                timeout = int(env.get('PIKU_HEALTHCHECK_TIMEOUT', '30'))
+            except ValueError:
+                timeout = 30
+            echo("-----> checking health of new workers at '{}'".format(env['PIKU_HEALTHCHECK_PATH']))
+            failed = [(k, w) for (k, w), mtime in spawned.items()
+                      if worker_address(app, k, env, w) and not wait_for_worker(app, k, w, env, mtime, timeout)]
+        if gated and failed:
+            echo("Error: health check failed for {}, rolling back.".format(", ".join("{}:{}.{}".format(app, k, w) for k, w in failed)), fg='red')
+            restore_app(app, snapshot, set(workers) | set(previous), previous_release, list(spawned) + restarted)
+            exit(1)
+
+    # Remove workers no longer in the Procfile
+    for k, v in previous.items():
+        if k not in workers:
+            to_destroy[k] = range(int(v), 0, -1)
 
     # Remove unnecessary workers (leave logfiles)
     for k, v in to_destroy.items():
@@ -1188,6 +2378,133 @@ def spawn_app(app, deltas={}):
     return env
 
 
+def worker_port(env, kind, ordinal=1):
+    """Returns the port a worker listens on, since every web worker has its own (see WEB_PORTS)"""
+
+    ports = env.get('WEB_PORTS', '').split(',') if kind == 'web' else []
+    if 0 < ordinal <= len(ports) and ports[ordinal - 1]:
+        return ports[ordinal - 1]
+    return env.get('PORT')
+
+
+def worker_address(app, kind, env, ordinal=1):
+    """Returns the (address, protocol) a worker serves requests on, or None for other kinds of workers"""
+
+    if kind == 'wsgi' and 'NGINX_SERVER_NAME' in env:
+        return join(NGINX_ROOT, "{}.sock".format(app)), 'uwsgi'
+    if kind in ['wsgi', 'web', 'php'] and 'PORT' in env:
+        return ('127.0.0.1' if kind == 'php' else env.get('BIND_ADDRESS', '127.0.0.1'), int(worker_port(env, kind, ordinal))), 'http'
+    return None
+
+
+def pidfile_mtime(app, kind, ordinal):
+    """Returns the modification time of a worker's pidfile (rewritten by uWSGI on every restart), or None"""
+
+    try:
+        return stat(join(UWSGI_ROOT, '{}_{}.{}.pid'.format(app, kind, ordinal))).st_mtime_ns
+    except OSError:
+        return None
+
+
+def healthy_status(status, env):
+    """Checks a probe response against PIKU_HEALTHCHECK_STATUS (any non-error status by default)"""
+
+    if not status:
+        return False
+    expected = env.get('PIKU_HEALTHCHECK_STATUS', '')
+    try:
+        ranges = [parse_status_range(x.strip()) for x in expected.split(',') if x.strip()]
+    except ValueError:
+        echo("Error: malformed setting 'PIKU_HEALTHCHECK_STATUS', ignoring it.", fg='red')
+        ranges = []
+    return any(low <= status <= high for low, high in ranges) if ranges else status < 500
+
+
+def wait_for_worker(app, kind, ordinal, env, previous, timeout):
+    """Waits for a (re)started worker to rewrite its pidfile and then answer requests"""
+
+    address = worker_address(app, kind, env, ordinal)
+    # wsgi workers share a socket (or port), so only their own stats socket tells whether this one is up
+    stats = join(UWSGI_ROOT, '{}_{}.{}.stats'.format(app, kind, ordinal)) if kind == 'wsgi' else None
+    deadline = time() + timeout
+    while time() < deadline:
+        mtime = pidfile_mtime(app, kind, ordinal)
+        if mtime is not None and mtime != previous:
+            ready = stats is None or any(w.get('status') in ['idle', 'busy', 'cheap'] for w in (read_worker_stats(stats) or {}).get('workers', []))
+            if ready and (address is None or healthy_status(probe_worker(*address, path=env.get('PIKU_HEALTHCHECK_PATH', '/')), env)):
+                return True
+        sleep(0.5)
+    return False
+
+
+def snapshot_app(app, kinds):
+    """Reads the live settings, scaling, nginx and uwsgi configs of an app for restore_app"""
+
+    paths = [join(ENV_ROOT, app, 'LIVE_ENV'), join(ENV_ROOT, app, 'SCALING'), join(NGINX_ROOT, '{}.conf'.format(app))]
+    for k in kinds:
+        for folder in [UWSGI_AVAILABLE, UWSGI_ENABLED]:
+            paths.extend(glob(join(folder, '{}_{}.*.ini'.format(app, k))))
+    snapshot = {}
+    for p in paths:
+        if exists(p):
+            with open(p, 'r') as h:
+                snapshot[p] = h.read()
+    return snapshot
+
+
+def restore_app(app, snapshot, kinds, release=None, started=()):
+    """Puts back the release and configs saved by snapshot_app, so the previous workers keep serving.
+       Workers in started are reloaded even if their configs did not change, since they run the failed release."""
+
+    if release and exists(release) and realpath(join(APP_ROOT, app)) != release:
+        activate_release(app, release)
+    current = snapshot_app(app, kinds)
+    for p in current:
+        if p not in snapshot:
+            remove(p)
+    # write uwsgi-enabled last, since that is what the emperor acts upon
+    reload = [join(UWSGI_ENABLED, '{}_{}.{}.ini'.format(app, k, w)) for k, w in started]
+    for p in sorted(snapshot, key=lambda x: x.startswith(UWSGI_ENABLED)):
+        if current.get(p) != snapshot[p] or p in reload:
+            with open(p, 'w') as h:
+                h.write(snapshot[p])
+    if any(p.startswith(NGINX_ROOT) for p in set(current) | set(snapshot)):
+        schedule_nginx_reload()
+    echo("-----> Restored previous configuration for '{}'".format(app), fg='yellow')
+
+
+def restart_workers(app, workers, env, running, gated=False):
+    """Restarts running workers a batch at a time, waiting for each batch to be healthy before the next one.
+       When gated, stops at the first unhealthy batch so the caller can roll back.
+       Returns the workers that failed and the ones that were restarted."""
+
+    try:
+        batch = max(int(env.get('PIKU_RESTART_BATCH', '1')), 1)
+        timeout = int(env.get('PIKU_HEALTHCHECK_TIMEOUT' if gated else 'PIKU_RESTART_TIMEOUT', '30'))
+    except ValueError:
+        echo("Error: malformed PIKU_RESTART_BATCH or timeout setting, using defaults.", fg='red')
+        batch, timeout = 1, 30
+
+    # without an emperor to pick up config changes there is nothing to wait for
+    wait = emperor_running()
+    failed, restarted = [], []
+    for i in range(0, len(running), batch):
+        previous = {}
+        for k, w in running[i:i + batch]:
+            echo("-----> restarting '{app:s}:{k:s}.{w:d}'".format(**locals()), fg='green')
+            previous[k, w] = pidfile_mtime(app, k, w)
+            spawn_worker(app, k, workers[k], env, w)
+            restarted.append((k, w))
+        for (k, w), mtime in previous.items():
+            if wait and not wait_for_worker(app, k, w, env, mtime, timeout):
+                echo("Warning: '{app:s}:{k:s}.{w:d}' not healthy after {timeout:d}s, restarting remaining workers without waiting.".format(**locals()), fg='yellow')
+                failed.append((k, w))
+                wait = False
+        if gated and failed:
+            break
+    return failed, restarted
+
+
 def spawn_worker(app, kind, command, env, ordinal=1):
     """Set up and deploy a single worker of a given kind"""
 
@@ -1197,6 +2514,7 @@ def spawn_worker(app, kind, command, env, ordinal=1):
     available = join(UWSGI_AVAILABLE, '{app:s}_{kind:s}.{ordinal:d}.ini'.format(**locals()))
     enabled = join(UWSGI_ENABLED, '{app:s}_{kind:s}.{ordinal:d}.ini'.format(**locals()))
     log_file = join(LOG_ROOT, app, kind)
+    sizing = uwsgi_sizing(app, kind, env)
 
     settings = [
         ('chdir', join(APP_ROOT, app)),
@@ -1205,8 +2523,8 @@ def spawn_worker(app, kind, command, env, ordinal=1):
         ('master', 'true'),
         ('project', app),
         ('max-requests', env.get('UWSGI_MAX_REQUESTS', '1024')),
-        ('listen', env.get('UWSGI_LISTEN', '48')),
-        ('processes', env.get('UWSGI_PROCESSES', '2')),
+        ('listen', sizing['listen']),
+        ('processes', sizing['processes']),
         ('procname-prefix', '{app:s}:{kind:s}:'.format(**locals())),
         ('enable-threads', env.get('UWSGI_ENABLE_THREADS', 'true').lower()),
         ('log-x-forwarded-for', env.get('UWSGI_LOG_X_FORWARDED_FOR', 'false').lower()),
@@ -1215,6 +2533,8 @@ def spawn_worker(app, kind, command, env, ordinal=1):
         ('logfile-chmod', '640'),
         ('logto2', '{log_file:s}.{ordinal:d}.log'.format(**locals())),
         ('log-backupname', '{log_file:s}.{ordinal:d}.log.old'.format(**locals())),
+        ('pidfile', join(UWSGI_ROOT, '{app:s}_{kind:s}.{ordinal:d}.pid'.format(**locals()))),
+        ('stats', join(UWSGI_ROOT, '{app:s}_{kind:s}.{ordinal:d}.stats'.format(**locals()))),
     ]
 
     # only add virtualenv to uwsgi if it's a real virtualenv
@@ -1234,6 +2554,9 @@ def spawn_worker(app, kind, command, env, ordinal=1):
             echo("Error: malformed setting 'UWSGI_IDLE', ignoring it.".format(), fg='red')
             pass
 
+    if kind in ['wsgi', 'jwsgi', 'rwsgi', 'php']:
+        settings.extend(uwsgi_cheaper_settings(env, sizing['processes']))
+
     if kind.startswith("cron"):
         settings.extend([
             ['cron', command.replace("*/", "-").replace("*", "-1")],
@@ -1242,7 +2565,7 @@ def spawn_worker(app, kind, command, env, ordinal=1):
     if kind == 'jwsgi':
         settings.extend([
             ('module', command),
-            ('threads', env.get('UWSGI_THREADS', '4')),
+            ('threads', sizing['threads']),
             ('plugin', 'jvm'),
             ('plugin', 'jwsgi')
         ])
@@ -1251,7 +2574,7 @@ def spawn_worker(app, kind, command, env, ordinal=1):
     if kind == 'rwsgi':
         settings.extend([
             ('module', command),
-            ('threads', env.get('UWSGI_THREADS', '4')),
+            ('threads', sizing['threads']),
             ('plugin', 'rack'),
             ('plugin', 'rbrequire'),
             ('plugin', 'post-buffering')
@@ -1262,7 +2585,7 @@ def spawn_worker(app, kind, command, env, ordinal=1):
     if kind == 'wsgi':
         settings.extend([
             ('module', command),
-            ('threads', env.get('UWSGI_THREADS', '4')),
+            ('threads', sizing['threads']),
         ])
 
         if python_version == 2:
@@ -1329,6 +2652,7 @@ def spawn_worker(app, kind, command, env, ordinal=1):
             ('php-index', 'index.php')
         ])
     elif kind == 'web':
+        env = dict(env, PORT=worker_port(env, kind, ordinal))
         echo("-----> nginx will talk to the 'web' process via {BIND_ADDRESS:s}:{PORT:s}".format(**env), fg='yellow')
         settings.append(('attach-daemon', command))
     elif kind == 'static':
@@ -1381,55 +2705,680 @@ def do_restart(app):
     spawn_app(app)
 
 
-def multi_tail(app, filenames, catch_up=20):
-    """Tails multiple log files"""
+def inotify_init():
+    """Returns a (libc, fd) tuple for a new inotify instance, or None if unavailable"""
 
-    # Seek helper
-    def peek(handle):
-        where = handle.tell()
-        line = handle.readline()
-        if not line:
-            handle.seek(where)
-            return None
-        return line
+    try:
+        libc = CDLL(find_library('c'), use_errno=True)
+        fd = libc.inotify_init()
+    except (OSError, AttributeError):
+        return None
+    return (libc, fd) if fd >= 0 else None
+
+
+def inotify_read(fd, timeout=None):
+    """Waits for inotify events and returns them as a list of (wd, mask, name) tuples"""
+
+    events = []
+    if not select([fd], [], [], timeout)[0]:
+        return events
+    buffer = read(fd, 65536)
+    offset = 0
+    while offset < len(buffer):
+        wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+        offset += INOTIFY_EVENT.size
+        events.append((wd, mask, buffer[offset:offset + length].rstrip(b'\0').decode('utf-8', errors='ignore')))
+        offset += length
+    return events
+
+
+def tail_lines(filename, count, block_size=65536):
+    """Returns the last count lines of a file, reading it backwards in fixed-size blocks"""
+
+    blocks = []
+    newlines = 0
+    with open(filename, 'rb') as h:
+        position = h.seek(0, 2)
+        # we need one extra newline to know the first line we return is complete
+        while position > 0 and newlines <= count:
+            size = min(block_size, position)
+            position -= size
+            h.seek(position)
+            blocks.append(h.read(size))
+            newlines += blocks[-1].count(b"\n")
+    lines = b"".join(reversed(blocks)).decode("utf-8", errors="ignore").splitlines(True)
+    return lines[-count:] if count > 0 else []
+
+
+def log_timestamp(line):
+    """Extracts a sortable timestamp from a uWSGI log line, if any"""
+
+    for pattern, fmt in LOG_TIMESTAMPS:
+        m = search(pattern, line)
+        if m:
+            try:
+                return datetime.strptime(m.group(1), fmt).strftime("%Y%m%d%H%M%S")
+            except ValueError:
+                pass
+    return None
 
-    inodes = {}
+
+def merge_log_lines(filenames, count):
+    """Returns the last count lines across log files, merged in timestamp order"""
+
+    def keyed(f):
+        # lines without a timestamp (tracebacks, etc.) stick to the previous one
+        last = ""
+        for line in tail_lines(f, count):
+            last = log_timestamp(line) or last
+            yield last, f, line
+
+    return deque(merge(*[keyed(f) for f in filenames], key=lambda x: x[0]), count)
+
+
+def multi_tail(app, filenames, catch_up=20, pattern=None):
+    """Tails multiple log files, following rotations and new files matching pattern.
+
+    Uses inotify to wake up only when files change, falling back to polling."""
+
+    log_path = join(LOG_ROOT, app)
+    inotify = inotify_init()
     files = {}
+    inodes = {}
     prefixes = {}
+    pending = {}
+    watches = {}
+    width = 0
+
+    def watch(path, mask):
+        # register an inotify watch, reverting to polling if we run out of them
+        nonlocal inotify
+        if inotify:
+            wd = inotify[0].inotify_add_watch(inotify[1], path.encode(), mask)
+            if wd < 0:
+                echo("Warning: could not watch '{}', falling back to polling.".format(path), fg='yellow')
+                close(inotify[1])
+                inotify = None
+            else:
+                watches[wd] = path
 
-    # Set up current state for each log file
-    for f in filenames:
+    def follow(f, whence):
+        nonlocal width
+        # open a file from the start (0) or end (2) of its current contents
+        try:
+            handle = open(f, "rt", encoding="utf-8", errors="ignore")
+        except OSError:
+            return
+        handle.seek(0, whence)
+        files[f] = handle
+        inodes[f] = fstat(handle.fileno()).st_ino
         prefixes[f] = splitext(basename(f))[0]
-        files[f] = open(f, "rt", encoding="utf-8", errors="ignore")
-        inodes[f] = stat(f).st_ino
-        files[f].seek(0, 2)
+        width = max(width, len(prefixes[f]))
+        watch(f, IN_MODIFY | IN_MOVE_SELF | IN_DELETE_SELF)
 
-    longest = max(map(len, prefixes.values()))
+    def tag(f, line):
+        return "{} | {}".format(prefixes[f].ljust(width), line)
 
-    # Grab a little history (if any)
-    for f in filenames:
-        for line in deque(open(f, "rt", encoding="utf-8", errors="ignore"), catch_up):
-            yield "{} | {}".format(prefixes[f].ljust(longest), line)
+    def drain(f):
+        # read complete lines only, holding on to partial writes until they are finished
+        while True:
+            line = files[f].readline()
+            if not line:
+                break
+            if not line.endswith("\n"):
+                pending[f] = pending.get(f, "") + line
+                break
+            yield tag(f, pending.pop(f, "") + line)
+
+    def rotated(f):
+        try:
+            return stat(f).st_ino != inodes[f]
+        except FileNotFoundError:
+            return True
 
-    while True:
-        updated = False
-        # Check for updates on every file
+    try:
+        # Set up current state for each log file
         for f in filenames:
-            line = peek(files[f])
-            if line:
-                updated = True
-                yield "{} | {}".format(prefixes[f].ljust(longest), line)
-
-        if not updated:
-            sleep(1)
-            # Check if logs rotated
-            for f in filenames:
-                if exists(f):
-                    if stat(f).st_ino != inodes[f]:
-                        files[f] = open(f)
-                        inodes[f] = stat(f).st_ino
+            follow(f, 2)
+        # Watch the log folder for new (or recreated) files
+        watch(log_path, IN_CREATE | IN_MOVED_TO)
+
+        # Grab a little history (if any)
+        for timestamp, f, line in merge_log_lines(filenames, catch_up):
+            yield tag(f, line if line.endswith("\n") else line + "\n")
+
+        touched, rescan = set(files), False
+        while True:
+            for f in touched:
+                if f not in files:
+                    continue
+                yield from drain(f)
+                # uWSGI renames the log to its backup name and reopens it, so read
+                # what was written to the old file since the drain above before letting go of it
+                if rotated(f):
+                    yield from drain(f)
+                    if pending.get(f):
+                        yield tag(f, pending.pop(f) + "\n")
+                    files.pop(f).close()
+                    for wd in [wd for wd, path in watches.items() if path == f]:
+                        if inotify:
+                            inotify[0].inotify_rm_watch(inotify[1], wd)
+                        del watches[wd]
+                    if exists(f):
+                        follow(f, 0)
+                        yield from drain(f)
+
+            if rescan:
+                for f in glob(join(log_path, pattern)) if pattern else filenames:
+                    if f not in files and exists(f):
+                        follow(f, 0)
+                        yield from drain(f)
+
+            if inotify:
+                touched, rescan = set(), False
+                for wd, mask, name in inotify_read(inotify[1]):
+                    path = watches.get(wd)
+                    if path == log_path:
+                        f = join(log_path, name)
+                        rescan = rescan or (fnmatch(name, pattern) if pattern else f in filenames)
+                    elif path:
+                        touched.add(path)
+            else:
+                sleep(1)
+                touched, rescan = set(files), True
+    finally:
+        # the generator is closed (or collected) once the caller stops reading
+        if inotify:
+            close(inotify[1])
+
+
+def log_files(app, process='*'):
+    """Returns the current and rotated log files for an app, oldest first"""
+
+    result = []
+    for f in sorted(glob(join(LOG_ROOT, app, process + '.*.log'))):
+        if exists(f + '.old'):
+            result.append(f + '.old')
+        result.append(f)
+    return result
+
+
+def read_log_lines(filenames):
+    """Yields (filename, line) for each line in a set of files, memory-mapping them"""
+
+    for f in filenames:
+        try:
+            with open(f, 'rb') as h:
+                if fstat(h.fileno()).st_size == 0:
+                    continue
+                with mmap(h.fileno(), 0, access=ACCESS_READ) as m:
+                    for line in iter(m.readline, b''):
+                        yield f, line.decode('utf-8', errors='ignore')
+        except OSError:
+            continue
+
+
+def parse_access_line(line):
+    """Parses a single access log line into a record, or returns None"""
+
+    m = ACCESS_LOG_REGEXP.match(line)
+    if not m:
+        return None
+    record = m.groupdict()
+    try:
+        record['time'] = datetime.strptime(record['time'], '%d/%b/%Y:%H:%M:%S %z')
+    except ValueError:
+        return None
+    record.update({
+        'status': int(record['status']),
+        'size': int(record['size']),
+        'msecs': int(record['msecs']),
+    })
+    return record
+
+
+def parse_access_log(lines):
+    """Turns (filename, line) pairs into access log records, skipping anything else"""
+
+    for f, line in lines:
+        record = parse_access_line(line)
+        if record:
+            record['worker'] = splitext(basename(f).replace('.log.old', '.log'))[0]
+            yield record
+
+
+def parse_status_range(value):
+    """Parses '500', '5xx' or '500-504' into an inclusive (low, high) tuple"""
+
+    if value.lower().endswith('xx'):
+        low = int(value[0]) * 100
+        return low, low + 99
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
+
+
+def parse_log_time(value):
+    """Parses an ISO date/time or a relative duration like '15m', '2h' or '1d' into an aware datetime"""
+
+    units = {'s': 'seconds', 'm': 'minutes', 'h': 'hours', 'd': 'days'}
+    if value[-1:] in units and value[:-1].isdigit():
+        return datetime.now().astimezone() - timedelta(**{units[value[-1]]: int(value[:-1])})
+    when = datetime.fromisoformat(value)
+    return when if when.tzinfo else when.astimezone()
+
+
+def filter_access_log(records, status=None, min_msecs=None, since=None, until=None, path=None):
+    """Filters access log records lazily"""
+
+    path = re_compile(path) if path else None
+    for r in records:
+        if status and not status[0] <= r['status'] <= status[1]:
+            continue
+        if min_msecs is not None and r['msecs'] < min_msecs:
+            continue
+        if since and r['time'] < since:
+            continue
+        if until and r['time'] > until:
+            continue
+        if path and not path.search(r['uri']):
+            continue
+        yield r
+
+
+def new_histogram():
+    """Returns an empty per-worker request histogram"""
+
+    return {'buckets': [0] * (len(LATENCY_BUCKETS) + 1), 'status': {}, 'first': None, 'last': None, 'sum': 0}
+
+
+def add_to_histogram(histogram, record):
+    """Accounts for a single access log record in a histogram"""
+
+    histogram['buckets'][bisect_left(LATENCY_BUCKETS, record['msecs'])] += 1
+    histogram['sum'] = histogram.get('sum', 0) + record['msecs']
+    status = "{}xx".format(record['status'] // 100)
+    histogram['status'][status] = histogram['status'].get(status, 0) + 1
+    when = record['time'].timestamp()
+    histogram['first'] = min(histogram['first'] or when, when)
+    histogram['last'] = max(histogram['last'] or when, when)
+
+
+def merge_histograms(histograms):
+    """Adds up a list of histograms"""
+
+    result = new_histogram()
+    for h in histograms:
+        result['buckets'] = [a + b for a, b in zip(result['buckets'], h['buckets'])]
+        result['sum'] += h.get('sum', 0)
+        for k, v in h['status'].items():
+            result['status'][k] = result['status'].get(k, 0) + v
+        if h['first'] is not None:
+            result['first'] = min(result['first'] or h['first'], h['first'])
+            result['last'] = max(result['last'] or h['last'], h['last'])
+    return result
+
+
+def histogram_percentile(histogram, percentile):
+    """Returns the upper bound (in ms) of the bucket holding a percentile, None for the overflow bucket"""
+
+    target = sum(histogram['buckets']) * percentile / 100.0
+    running = 0
+    for i, count in enumerate(histogram['buckets']):
+        running += count
+        if count and running >= target:
+            return LATENCY_BUCKETS[i] if i < len(LATENCY_BUCKETS) else None
+    return 0
+
+
+def update_latency_stats(app):
+    """Scans new access log entries since the last run and returns updated per-worker histograms"""
+
+    state_file = join(ENV_ROOT, app, 'STATS')
+    # piku stats and metrics scrapes may run at once, so only one of them updates the state at a time
+    with open(state_file + '.lock', 'a') as lock:
+        flock(lock, LOCK_EX)
+        try:
+            try:
+                with open(state_file, 'r') as h:
+                    state = loads(h.read())
+            except (OSError, ValueError):
+                state = {}
+            files = state.setdefault('files', {})
+            workers = state.setdefault('workers', {})
+
+            for f in glob(join(LOG_ROOT, app, '*.*.log')):
+                worker = splitext(basename(f))[0]
+                try:
+                    info = stat(f)
+                except FileNotFoundError:
+                    continue
+                seen = files.get(f, {})
+                if seen.get('inode') == info.st_ino and info.st_size >= seen['offset']:
+                    sources = [(f, info.st_ino, seen['offset'])]
                 else:
-                    filenames.remove(f)
+                    sources = [(f, info.st_ino, 0)]
+                    # pick up whatever was written before uWSGI rotated the log
+                    if seen and exists(f + '.old') and stat(f + '.old').st_ino == seen['inode']:
+                        sources.insert(0, (f + '.old', seen['inode'], seen['offset']))
+                for path, inode, offset in sources:
+                    try:
+                        h = open(path, 'rb')
+                    except FileNotFoundError:
+                        # rotated away since, so it will be picked up as the .old file next time
+                        break
+                    with h:
+                        h.seek(offset)
+                        for line in iter(h.readline, b''):
+                            if not line.endswith(b'\n'):
+                                break
+                            offset += len(line)
+                            record = parse_access_line(line.decode('utf-8', errors='ignore'))
+                            if record:
+                                add_to_histogram(workers.setdefault(worker, new_histogram()), record)
+                    files[f] = {'inode': inode, 'offset': offset}
+
+            with open(state_file + '.tmp', 'w') as h:
+                h.write(dumps(state))
+            replace(state_file + '.tmp', state_file)
+        finally:
+            flock(lock, LOCK_UN)
+    return workers
+
+
+def enabled_workers():
+    """Returns (app, worker) for every enabled uWSGI vassal, e.g. ('blog', 'web.1')"""
+
+    # app names can contain underscores, so match them against the deployed apps
+    apps = sorted(listdir(APP_ROOT), key=len, reverse=True)
+    result = []
+    for ini in sorted(glob(join(UWSGI_ENABLED, '*.ini'))):
+        name = basename(ini)[:-len('.ini')]
+        app = next((a for a in apps if name.startswith(a + '_')), None)
+        if app:
+            result.append((app, name[len(app) + 1:]))
+    return result
+
+
+def read_pidfile(app, worker):
+    """Returns the pid of a worker's uWSGI master, or None"""
+
+    try:
+        with open(join(UWSGI_ROOT, '{}_{}.pid'.format(app, worker)), 'r') as h:
+            return int(h.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def read_meminfo():
+    """Returns the total and available memory of the host in bytes"""
+
+    info = {}
+    with open('/proc/meminfo', 'r') as h:
+        for line in h:
+            key, _, value = line.partition(':')
+            info[key] = int(value.split()[0]) * 1024
+    # kernels before 3.14 do not estimate available memory
+    return info['MemTotal'], info.get('MemAvailable', info['MemFree'] + info.get('Cached', 0))
+
+
+def uwsgi_sizing(app, kind, env):
+    """Returns the processes, threads and listen queue size for a worker, working out those set to 'auto'
+       from the CPUs and memory of the host, the apps deployed on it and how much memory the worker used last time"""
+
+    sizing = {'processes': env.get('UWSGI_PROCESSES', '2'), 'threads': env.get('UWSGI_THREADS', '4'), 'listen': env.get('UWSGI_LISTEN', '48')}
+    auto = [k for k, v in sizing.items() if v.strip().lower() == 'auto']
+    if not auto:
+        return sizing
+
+    # measure the running worker, if any, since the new one will take its place
+    table = process_table()
+    used = processes = 0
+    for pidfile in glob(join(UWSGI_ROOT, '{}_{}.*.pid'.format(app, kind))):
+        tree = process_tree(table, read_pidfile(app, basename(pidfile)[len(app) + 1:-len('.pid')]))
+        used += sum(table[p][2] for p in tree)
+        processes += len(tree)
+    sizing_file = join(ENV_ROOT, app, 'SIZING')
+    measured = parse_settings(sizing_file, {})
+    if processes:
+        measured[kind] = str(used // processes)
+        write_config(sizing_file, measured)
+    rss = int(measured.get(kind, UWSGI_AUTO_RSS))
+
+    # every app gets a fair share of the host, but no more than is actually free, split between
+    # its request serving workers since each kind and ordinal (see SCALING) is a vassal of its own
+    serving = ['wsgi', 'jwsgi', 'rwsgi', 'php']
+    scaling = parse_procfile(join(ENV_ROOT, app, 'SCALING')) or {}
+    vassals = max(sum(int(v) for k, v in scaling.items() if k in serving and str(v).isdigit()), 1)
+    apps = len(set(a for a, _ in enabled_workers()) | {app})
+    total, available = read_meminfo()
+    budget = min((available + used) * 0.8, total * 0.8 / apps) / vassals
+    cpus = max(cpu_count() // (apps * vassals), 1)
+    try:
+        with open('/proc/sys/net/core/somaxconn', 'r') as h:
+            somaxconn = int(h.read())
+    except (OSError, ValueError):
+        somaxconn = 128
+
+    # only these kinds serve requests from uWSGI processes, the others just need a master
+    processes = max(min(cpus, int(budget // rss)), 1) if kind in serving else 1
+    threads = min(max(4 * cpus // processes, 4), 16)
+    computed = {'processes': processes, 'threads': threads, 'listen': min(max(processes * threads * 8, 64), somaxconn)}
+    for k in auto:
+        sizing[k] = str(computed[k])
+    echo("-----> uwsgi will run {} processes with {} threads and a listen queue of {} (sized for {} CPUs and {} of memory, at {} per process)".format(
+        sizing['processes'], sizing['threads'], sizing['listen'], cpus, human_size(budget), human_size(rss)), fg='yellow')
+    return sizing
+
+
+def uwsgi_cheaper_settings(env, processes):
+    """Returns the uWSGI cheaper settings for the UWSGI_CHEAPER_* keys, or none if they are unset or invalid"""
+
+    if 'UWSGI_CHEAPER' not in env:
+        return []
+    algo = env.get('UWSGI_CHEAPER_ALGO', 'spare').strip().lower()
+    try:
+        processes = int(processes)
+        cheaper = int(env['UWSGI_CHEAPER'])
+        initial = int(env.get('UWSGI_CHEAPER_INITIAL', str(cheaper)))
+        step = int(env.get('UWSGI_CHEAPER_STEP', '1'))
+        overload = int(env.get('UWSGI_CHEAPER_OVERLOAD', '3'))
+        busyness = [int(env.get('UWSGI_CHEAPER_BUSYNESS_' + k, d)) for k, d in [('MIN', '25'), ('MAX', '50'), ('MULTIPLIER', '10')]]
+    except ValueError as e:
+        echo("Error: malformed UWSGI_CHEAPER settings ({}), ignoring them.".format(e), fg='red')
+        return []
+
+    errors = []
+    if not 1 <= cheaper < processes:
+        errors.append("UWSGI_CHEAPER must be at least 1 and lower than UWSGI_PROCESSES ({})".format(processes))
+    if not cheaper <= initial <= processes:
+        errors.append("UWSGI_CHEAPER_INITIAL must be between UWSGI_CHEAPER and UWSGI_PROCESSES")
+    if step < 1 or overload < 1:
+        errors.append("UWSGI_CHEAPER_STEP and UWSGI_CHEAPER_OVERLOAD must be at least 1")
+    if algo not in UWSGI_CHEAPER_ALGOS:
+        errors.append("UWSGI_CHEAPER_ALGO must be one of {}".format(", ".join(UWSGI_CHEAPER_ALGOS)))
+    if algo == 'busyness' and not (0 <= busyness[0] < busyness[1] <= 100 and busyness[2] >= 1):
+        errors.append("UWSGI_CHEAPER_BUSYNESS_MIN must be lower than UWSGI_CHEAPER_BUSYNESS_MAX, both percentages, and UWSGI_CHEAPER_BUSYNESS_MULTIPLIER at least 1")
+    if errors:
+        for error in errors:
+            echo("Error: {}, ignoring UWSGI_CHEAPER settings.".format(error), fg='red')
+        return []
+
+    settings = [
+        ('cheaper-algo', algo),
+        ('cheaper', cheaper),
+        ('cheaper-initial', initial),
+        ('cheaper-step', step),
+        ('cheaper-overload', overload),
+    ]
+    if algo == 'busyness':
+        settings.extend([
+            ('cheaper-busyness-min', busyness[0]),
+            ('cheaper-busyness-max', busyness[1]),
+            ('cheaper-busyness-multiplier', busyness[2]),
+        ])
+    echo("-----> uwsgi will scale between {} and {} processes ({}, starting with {}, {} at a time)".format(cheaper, processes, algo, initial, step), fg='yellow')
+    return settings
+
+
+def process_table():
+    """Returns {pid: (ppid, cpu seconds, rss bytes)} for every process, read from /proc"""
+
+    ticks, page = sysconf('SC_CLK_TCK'), sysconf('SC_PAGE_SIZE')
+    table = {}
+    for entry in listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry), 'r') as h:
+                # the command name may contain spaces, and the state follows it as field 3
+                fields = h.read().rsplit(')', 1)[1].split()
+            table[int(entry)] = (int(fields[1]), (int(fields[11]) + int(fields[12])) / ticks, int(fields[21]) * page)
+        except (OSError, IndexError, ValueError):
+            continue
+    return table
+
+
+def process_tree(table, pid):
+    """Returns the pids of a process and everything it started, given a process_table()"""
+
+    children = defaultdict(list)
+    for child, (ppid, _, _) in table.items():
+        children[ppid].append(child)
+    tree = [pid] if pid in table else []
+    for p in tree:
+        tree.extend(children.get(p, []))
+    return tree
+
+
+def worker_samples(workers):
+    """Collects process and uWSGI stats samples for a list of (app, worker)"""
+
+    table = process_table()
+    sockets = [join(UWSGI_ROOT, '{}_{}.stats'.format(app, worker)) for app, worker in workers]
+    with ThreadPool(max(len(sockets), 1)) as pool:
+        stats = pool.map(read_worker_stats, sockets)
+
+    samples = []
+    for (app, worker), data in zip(workers, stats):
+        labels = {'app': app, 'worker': worker}
+        samples.append(('piku_worker_up', '', labels, int(data is not None)))
+        # the uWSGI master, its workers and attached daemons, and anything they started
+        tree = [table[pid] for pid in process_tree(table, read_pidfile(app, worker))]
+        samples.extend([
+            ('piku_worker_processes', '', labels, len(tree)),
+            ('piku_worker_resident_memory_bytes', '', labels, sum(p[2] for p in tree)),
+            ('piku_worker_cpu_seconds_total', '', labels, round(sum(p[1] for p in tree), 2)),
+        ])
+        if data is None:
+            continue
+        listen = (data.get('sockets') or [{}])[0]
+        processes = data.get('workers', [])
+        served = [p for p in processes if p.get('requests')]
+        samples.extend([
+            ('piku_uwsgi_listen_queue', '', labels, listen.get('queue', data.get('listen_queue', 0))),
+            ('piku_uwsgi_busy_processes', '', labels, len([p for p in processes if p.get('status') == 'busy'])),
+            ('piku_uwsgi_requests_total', '', labels, sum(p.get('requests', 0) for p in processes)),
+            ('piku_uwsgi_exceptions_total', '', labels, sum(p.get('exceptions', 0) for p in processes)),
+            ('piku_uwsgi_respawns_total', '', labels,
+             sum(p.get('respawn_count', 0) for p in processes) + sum(d.get('respawns', 0) for d in data.get('daemons', []))),
+            ('piku_uwsgi_average_response_seconds', '', labels,
+             sum(p.get('avg_rt', 0) for p in served) / len(served) / 1000000.0 if served else 0),
+        ])
+        if 'max_queue' in listen:
+            samples.append(('piku_uwsgi_listen_queue_max', '', labels, listen['max_queue']))
+    return samples
+
+
+def latency_samples(apps):
+    """Collects request counters and latency histograms from the access logs of a list of apps"""
+
+    samples = []
+    for app in apps:
+        for worker, h in sorted(update_latency_stats(app).items()):
+            labels = {'app': app, 'worker': worker}
+            for status, count in sorted(h['status'].items()):
+                samples.append(('piku_http_requests_total', '', dict(labels, status=status), count))
+            running = 0
+            for bound, count in zip(LATENCY_BUCKETS + [None], h['buckets']):
+                running += count
+                samples.append(('piku_http_request_duration_seconds', '_bucket', dict(labels, le='+Inf' if bound is None else str(bound / 1000.0)), running))
+            samples.append(('piku_http_request_duration_seconds', '_sum', labels, h.get('sum', 0) / 1000.0))
+            samples.append(('piku_http_request_duration_seconds', '_count', labels, running))
+    return samples
+
+
+def cache_samples(apps):
+    """Collects nginx cache disk usage for a list of apps"""
+
+    samples = []
+    for app in apps:
+        path = nginx_cache_path(app, parse_settings(join(ENV_ROOT, app, 'LIVE_ENV'), {}))
+        entries, size, denied = 0, 0, []
+        for root, _, files in walk(path, onerror=denied.append):
+            for name in files:
+                try:
+                    size += lstat(join(root, name)).st_size
+                    entries += 1
+                except OSError:
+                    denied.append(name)
+        labels = {'app': app}
+        samples.extend([
+            ('piku_nginx_cache_entries', '', labels, entries),
+            ('piku_nginx_cache_bytes', '', labels, size),
+            ('piku_nginx_cache_unreadable', '', labels, len(denied)),
+        ])
+    return samples
+
+
+def run_collector(name, collector, args, ttl=0):
+    """Runs a metrics collector, reusing results recorded in METRICS_CACHE for ttl seconds (and the same arguments)"""
+
+    cache = {}
+    if ttl > 0:
+        try:
+            with open(METRICS_CACHE, 'r') as h:
+                cache = loads(h.read())
+            entry = cache.get(name, {})
+            if entry.get('args') == args and time() - entry['time'] < ttl:
+                return [tuple(sample) for sample in entry['samples']]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    start = monotonic()
+    samples = collector(args)
+    samples.append(('piku_metrics_collector_seconds', '', {'collector': name}, round(monotonic() - start, 6)))
+    if ttl > 0:
+        cache[name] = {'time': time(), 'args': args, 'samples': samples}
+        with open(METRICS_CACHE + '.tmp', 'w') as h:
+            h.write(dumps(cache))
+        replace(METRICS_CACHE + '.tmp', METRICS_CACHE)
+    return samples
+
+
+def collect_metrics(ttl):
+    """Gathers samples for every enabled worker in one pass, scanning logs and caches at most every ttl seconds"""
+
+    workers = enabled_workers()
+    apps = sorted(set(app for app, _ in workers))
+    samples = run_collector('workers', worker_samples, workers)
+    samples += run_collector('logs', latency_samples, apps, ttl)
+    samples += run_collector('nginx_cache', cache_samples, apps, ttl)
+    return samples
+
+
+def render_metrics(samples):
+    """Formats samples as Prometheus text"""
+
+    lines = []
+    for family, (kind, description) in METRICS.items():
+        family_samples = [sample for sample in samples if sample[0] == family]
+        if not family_samples:
+            continue
+        lines.extend(["# HELP {} {}".format(family, description), "# TYPE {} {}".format(family, kind)])
+        for _, suffix, labels, value in family_samples:
+            labels = ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels.items())
+            lines.append("{}{}{{{}}} {}".format(family, suffix, labels, value))
+    return "\n".join(lines) + "\n"
 
 
 # === CLI commands ===
@@ -1467,6 +3416,104 @@ def cmd_apps():
         echo(('*' if running else ' ') + a, fg='green')
 
 
+@piku.command("cache:stats")
+@argument('app', required=False)
+def cmd_cache_stats(app):
+    """Show package or nginx cache usage, e.g.: piku cache:stats [<app>]"""
+
+    if app:
+        app = exit_if_invalid(app)
+        path = nginx_cache_path(app, parse_settings(join(ENV_ROOT, app, 'LIVE_ENV'), {}))
+        entries, denied = nginx_cache_entries(path)
+        echo("-----> nginx cache for '{}' in {}: {} entries, {}".format(app, path, len(entries), human_size(sum(e[2] for e in entries))), fg='green')
+        if denied:
+            echo("-----> {} files or folders belong to nginx and could not be read".format(denied), fg='yellow')
+        counts, first, last = read_cache_log(app)
+        if rotate_cache_log(app):
+            schedule_nginx_reload()
+        requests = sum(counts.values())
+        if not requests:
+            echo("No cached requests logged for app '{}'.".format(app), fg='yellow')
+            return
+        echo("{:<12} {:>10} {:>8}".format('status', 'requests', 'share'), fg='green')
+        for status, count in sorted(counts.items(), key=lambda c: -c[1]):
+            echo("{:<12} {:>10d} {:>7.1f}%".format(status, count, 100.0 * count / requests), fg='white')
+        hits = sum(counts[s] for s in ['HIT', 'STALE', 'UPDATING', 'REVALIDATED'])
+        echo("-----> {:.1f}% of {} requests served from cache between {:%Y-%m-%d %H:%M} and {:%Y-%m-%d %H:%M}".format(
+            100.0 * hits / requests, requests, datetime.fromtimestamp(first), datetime.fromtimestamp(last)), fg='green')
+        return
+
+    total = 0
+    echo("{:<12} {:>10} {:>10}  {}".format('cache', 'files', 'size', 'last used'), fg='green')
+    for name in PACKAGE_CACHE_NAMES:
+        entries = scan_tree(join(PACKAGE_CACHE_ROOT, name))
+        size = sum(e[1] for e in entries)
+        total += size
+        last = datetime.fromtimestamp(max(e[2] for e in entries)).strftime('%Y-%m-%d %H:%M') if entries else '-'
+        echo("{:<12} {:>10d} {:>10}  {}".format(name, len(entries), human_size(size), last), fg='white')
+    echo("{:<12} {:>10} {:>10}".format('total', '', human_size(total)), fg='white')
+
+
+@piku.command("cache:prune")
+@option('--max-size', '-s', default='10G', help='Size to trim the shared package cache down to, e.g. 5G')
+def cmd_cache_prune(max_size):
+    """Empty least recently used package caches, e.g.: piku cache:prune -s 5G"""
+
+    try:
+        limit = parse_size(max_size)
+    except ValueError:
+        echo("Error: invalid size '{}'".format(max_size), fg='red')
+        return
+
+    caches = []
+    for name in PACKAGE_CACHE_NAMES:
+        entries = scan_tree(join(PACKAGE_CACHE_ROOT, name))
+        if entries:
+            caches.append((max(e[2] for e in entries), name, sum(e[1] for e in entries)))
+    total = sum(c[2] for c in caches)
+    freed, removed = 0, []
+    # package managers index what they unpacked (e.g. cargo's .cargo-ok markers), so caches are only emptied as a whole
+    for _, name, size in sorted(caches):
+        if total - freed <= limit:
+            break
+        path = join(PACKAGE_CACHE_ROOT, name)
+        try:
+            # onerror is deprecated from Python 3.12 on, in favour of onexc
+            rmtree(path, **{'onexc' if version_info >= (3, 12) else 'onerror': remove_readonly})
+            makedirs(path)
+        except OSError as e:
+            echo("Warning: could not empty the '{}' cache: {}".format(name, e), fg='yellow')
+            continue
+        freed += size
+        removed.append(name)
+    echo("-----> Emptied {} caches ({}), freed {} ({} in use).".format(
+        len(removed), ", ".join(removed) or "none", human_size(freed), human_size(total - freed)), fg='green')
+
+
+@piku.command("cache:purge")
+@argument('app')
+@argument('prefix', default='/')
+def cmd_cache_purge(app, prefix):
+    """Remove nginx cache entries by URL prefix, e.g.: piku cache:purge <app> [/prefix]"""
+
+    app = exit_if_invalid(app)
+    path = nginx_cache_path(app, parse_settings(join(ENV_ROOT, app, 'LIVE_ENV'), {}))
+    entries, denied = nginx_cache_entries(path)
+    removed = freed = 0
+    for filename, key, size in entries:
+        # keys start with the scheme and host, which cannot contain a slash
+        if '/' in key and key[key.index('/'):].startswith(prefix):
+            try:
+                remove(filename)
+            except OSError:
+                denied += 1
+                continue
+            removed, freed = removed + 1, freed + size
+    echo("-----> Removed {} cache entries under '{}', freed {}.".format(removed, prefix, human_size(freed)), fg='green')
+    if denied:
+        echo("-----> {} cache files or folders belong to nginx and could not be purged".format(denied), fg='yellow')
+
+
 @piku.command("config")
 @argument('app')
 def cmd_config(app):
@@ -1561,6 +3608,79 @@ def cmd_deploy(app):
     do_deploy(app)
 
 
+@piku.command("deploy:all")
+@option('--jobs', '-j', default=cpu_count(), type=int, help='number of apps to build at once')
+def cmd_deploy_all(jobs):
+    """Rebuild all apps in parallel, e.g.: piku deploy:all [-j 4]"""
+
+    apps = sorted(a for a in listdir(APP_ROOT) if not a.startswith('.'))
+    if not apps:
+        echo("There are no applications deployed.")
+        return
+    jobs = max(1, min(jobs, len(apps)))
+    echo("-----> Rebuilding {} apps, {} at a time (output in {})".format(len(apps), jobs, join(LOG_ROOT, '<app>', 'deploy.log')), fg='green')
+    results = []
+    start = time()
+    # a fresh process per app, since deploys can exit() or leave state behind
+    with Pool(jobs, maxtasksperchild=1) as pool:
+        for app, status, duration, logfile in pool.imap_unordered(deploy_logged, apps):
+            results.append((app, status, duration, logfile))
+            failures = len([r for r in results if r[1]])
+            echo("-----> [{}/{}] {} {} in {:.1f}s ({} running, {} failed)".format(
+                len(results), len(apps), app, 'failed' if status else 'done', duration,
+                min(jobs, len(apps) - len(results)), failures), fg='red' if status else 'green')
+
+    echo("{:<24} {:>8} {:>10}  {}".format('app', 'status', 'duration', 'log'), fg='green')
+    for app, status, duration, logfile in sorted(results, key=lambda r: (not r[1], -r[2])):
+        echo("{:<24} {:>8} {:>9.1f}s  {}".format(app, 'failed' if status else 'ok', duration, logfile), fg='red' if status else 'white')
+    failed = [r[0] for r in results if r[1]]
+    echo("-----> {} apps rebuilt in {:.1f}s, {} failed".format(len(results) - len(failed), time() - start, len(failed)), fg='red' if failed else 'green')
+    if failed:
+        exit(1)
+
+
+@piku.command("deploy:history")
+@argument('app')
+@option('--count', '-n', default=5, help='number of recent deploys to show')
+def cmd_deploy_history(app, count):
+    """Show deploy phase timings, e.g.: piku deploy:history <app> [-n 10]"""
+
+    app = exit_if_invalid(app)
+    records = read_deploy_history(app)[-max(count, 1):]
+    if not records:
+        echo("No deploys recorded for app '{}'.".format(app), fg='yellow')
+        return
+
+    # phases can repeat within a deploy (e.g. several spawns), so add them up
+    timings = []
+    for r in records:
+        phases = defaultdict(float)
+        for name, seconds in r['phases']:
+            phases[name] += seconds
+        timings.append(phases)
+    names = list(dict.fromkeys(name for r in records for name, _ in r['phases']))
+
+    def row(label, values, trend=''):
+        return "{:<16}".format(label) + "".join("{:>13}".format(v) for v in values) + "  " + trend
+
+    def trend(values):
+        # latest deploy compared to the average of the earlier ones
+        earlier = [v for v in values[:-1] if v is not None]
+        if values[-1] is None or not earlier or not sum(earlier):
+            return ''
+        return "{:+.0f}%".format((values[-1] / (sum(earlier) / len(earlier)) - 1) * 100)
+
+    echo(row('phase', [datetime.fromisoformat(r['time']).strftime('%m-%d %H:%M') for r in records], 'trend'), fg='green')
+    echo(row('release', [(r.get('release') or '')[:9] for r in records]), fg='white')
+    for name in names:
+        values = [t[name] if name in t else None for t in timings]
+        echo(row(name, ['-' if v is None else '{:.2f}s'.format(v) for v in values], trend(values)), fg='white')
+    totals = [r['total'] for r in records]
+    echo(row('total', ['{:.2f}s'.format(v) for v in totals], trend(totals)), fg='green')
+    echo(row('status', ['ok' if not r['status'] else 'exit {}'.format(r['status']) for r in records]),
+         fg='red' if records[-1]['status'] else 'green')
+
+
 @piku.command("destroy")
 @argument('app')
 def cmd_destroy(app):
@@ -1570,12 +3690,17 @@ def cmd_destroy(app):
 
     # leave DATA_ROOT, since apps may create hard to reproduce data,
     # and CACHE_ROOT, since `nginx` will set permissions to protect it
-    for p in [join(x, app) for x in [APP_ROOT, GIT_ROOT, ENV_ROOT, LOG_ROOT]]:
+    app_path = join(APP_ROOT, app)
+    if islink(app_path):
+        echo("--> Removing link '{}'".format(app_path), fg='yellow')
+        unlink(app_path)
+
+    for p in [join(x, app) for x in [APP_ROOT, RELEASE_ROOT, GIT_ROOT, ENV_ROOT, LOG_ROOT]]:
         if exists(p):
             echo("--> Removing folder '{}'".format(p), fg='yellow')
             rmtree(p)
 
-    for p in [join(x, '{}*.ini'.format(app)) for x in [UWSGI_AVAILABLE, UWSGI_ENABLED]]:
+    for p in [join(x, '{}*.ini'.format(app)) for x in [UWSGI_AVAILABLE, UWSGI_ENABLED]] + [join(UWSGI_ROOT, '{}_*.{}'.format(app, x)) for x in ['pid', 'stats']]:
         g = glob(p)
         if len(g) > 0:
             for f in g:
@@ -1583,10 +3708,13 @@ def cmd_destroy(app):
                 remove(f)
 
     nginx_files = [join(NGINX_ROOT, "{}.{}".format(app, x)) for x in ['conf', 'sock', 'key', 'crt']]
+    served = exists(nginx_files[0])
     for f in nginx_files:
         if exists(f):
             echo("--> Removing file '{}'".format(f), fg='yellow')
             remove(f)
+    if served:
+        schedule_nginx_reload()
 
     acme_link = join(ACME_WWW, app)
     acme_certs = realpath(acme_link)
@@ -1605,19 +3733,156 @@ def cmd_destroy(app):
 @piku.command("logs")
 @argument('app')
 @argument('process', nargs=1, default='*')
-def cmd_logs(app, process):
-    """Tail running logs, e.g: piku logs <app> [<process>]"""
+@option('--lines', '-n', default=20, type=IntRange(0), help='Number of past lines to show before following')
+def cmd_logs(app, process, lines):
+    """Tail running logs, e.g: piku logs <app> [<process>] [-n <lines>]"""
 
     app = exit_if_invalid(app)
 
     logfiles = glob(join(LOG_ROOT, app, process + '.*.log'))
     if len(logfiles) > 0:
-        for line in multi_tail(app, logfiles):
+        for line in multi_tail(app, logfiles, catch_up=lines, pattern=process + '.*.log'):
             echo(line.strip(), fg='white')
     else:
         echo("No logs found for app '{}'.".format(app), fg='yellow')
 
 
+@piku.command("logs:query")
+@argument('app')
+@argument('process', nargs=1, default='*')
+@option('--status', '-s', help='Status code or range, e.g. 404, 5xx or 500-504')
+@option('--min-ms', '-m', type=int, help='Only requests that took at least this many milliseconds')
+@option('--since', help='Start time (ISO format) or age, e.g. 15m, 2h, 1d')
+@option('--until', help='End time (ISO format) or age, e.g. 15m, 2h, 1d')
+@option('--path', '-p', help='Regular expression to match request URIs against')
+@option('--json', 'as_json', is_flag=True, help='Output one JSON record per line')
+def cmd_logs_query(app, process, status, min_ms, since, until, path, as_json):
+    """Query access logs, e.g: piku logs:query <app> [<process>] -s 5xx -m 500"""
+
+    app = exit_if_invalid(app)
+
+    try:
+        status = parse_status_range(status) if status else None
+        since = parse_log_time(since) if since else None
+        until = parse_log_time(until) if until else None
+        path = re_compile(path) if path else None
+    except (ValueError, re_error) as e:
+        echo("Error: invalid filter: {}".format(e), fg='red')
+        return
+
+    logfiles = log_files(app, process)
+    if not logfiles:
+        echo("No logs found for app '{}'.".format(app), fg='yellow')
+        return
+
+    records = filter_access_log(parse_access_log(read_log_lines(logfiles)), status, min_ms, since, until, path)
+    for r in records:
+        if as_json:
+            echo(dumps(dict(r, time=r['time'].isoformat())))
+        else:
+            echo("{worker} | {time:%Y-%m-%d %H:%M:%S} {status} {msecs:>6d}ms {size:>8d} {method} {uri}".format(**r),
+                 fg='red' if r['status'] >= 500 else 'yellow' if r['status'] >= 400 else 'white')
+
+
+@piku.command("stats")
+@argument('app')
+@option('--reset', is_flag=True, help='Discard accumulated statistics and start over')
+def cmd_stats(app, reset):
+    """Show request latency statistics, e.g: piku stats <app>"""
+
+    app = exit_if_invalid(app)
+
+    state_file = join(ENV_ROOT, app, 'STATS')
+    if reset and exists(state_file):
+        remove(state_file)
+    workers = update_latency_stats(app)
+    if not workers:
+        echo("No requests logged for app '{}'.".format(app), fg='yellow')
+        return
+
+    def ms(value):
+        return ">{}ms".format(LATENCY_BUCKETS[-1]) if value is None else "{}ms".format(value)
+
+    classes = sorted(set(k for w in workers.values() for k in w['status']))
+    header = "{:<12} {:>9} {:>8} {:>8} {:>8} {:>8} ".format('worker', 'requests', 'req/s', 'p50', 'p90', 'p99')
+    echo(header + " ".join("{:>7}".format(c) for c in classes), fg='green')
+    for name, h in sorted(workers.items()) + [('total', merge_histograms(workers.values()))]:
+        count = sum(h['buckets'])
+        rate = count / max(h['last'] - h['first'], 1) if count else 0
+        line = "{:<12} {:>9d} {:>8.2f} {:>8} {:>8} {:>8} ".format(
+            name, count, rate, ms(histogram_percentile(h, 50)), ms(histogram_percentile(h, 90)), ms(histogram_percentile(h, 99)))
+        echo(line + " ".join("{:>7d}".format(h['status'].get(c, 0)) for c in classes), fg='white')
+
+
+@piku.command("metrics")
+@option('--cache', '-c', default=60, help='Seconds to reuse access log and nginx cache figures for')
+def cmd_metrics(cache):
+    """Print metrics for all apps in Prometheus format, e.g: piku metrics"""
+
+    echo(render_metrics(collect_metrics(cache)), nl=False)
+
+
+@piku.command("metrics:serve")
+@option('--bind', '-b', default='127.0.0.1', help='Address to listen on')
+@option('--port', '-p', default=9193, help='Port to listen on')
+@option('--cache', '-c', default=60, help='Seconds to reuse access log and nginx cache figures for')
+def cmd_metrics_serve(bind, port, cache):
+    """Serve metrics for all apps to Prometheus, e.g: piku metrics:serve -p 9193"""
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ['/', '/metrics']:
+                self.send_error(404)
+                return
+            body = render_metrics(collect_metrics(cache)).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    echo("-----> Serving metrics on http://{}:{}/metrics".format(bind, port), fg='green')
+    try:
+        HTTPServer((bind, port), MetricsHandler).serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+@piku.command("nginx:reload")
+@option('--queued', is_flag=True, hidden=True)
+def cmd_nginx_reload(queued):
+    """Queue an nginx reload and show reload stats, e.g.: piku nginx:reload"""
+
+    if queued:
+        # wait out the queue delay, then reload once for every change made meanwhile
+        with nginx_reload_queue() as state:
+            pending = state.get('pending') or time()
+        sleep(max(0, pending - time()))
+        with nginx_reload_queue() as state:
+            state['pending'] = state['waiter'] = None
+        errors = reload_nginx()
+        with nginx_reload_queue() as state:
+            if errors:
+                state['failed'] += 1
+                state['error'] = errors
+            else:
+                state['reloads'] += 1
+                state['error'] = None
+            state['last'] = datetime.now().isoformat(timespec='seconds')
+        return
+
+    schedule_nginx_reload()
+    with nginx_reload_queue() as state:
+        echo("-----> {requested} reloads requested, {reloads} done, {saved} saved by batching, {failed} failed".format(**state), fg='green')
+        if state.get('last'):
+            echo("-----> last reload: {}".format(state['last']))
+        if state.get('error'):
+            echo("Error: [nginx config] {}".format(state['error']), fg='red')
+
+
 @piku.command("ps")
 @argument('app')
 def cmd_ps(app):
@@ -1632,6 +3897,55 @@ def cmd_ps(app):
         echo("Error: no workers found for app '{}'.".format(app), fg='red')
 
 
+@piku.command("ps:top")
+@argument('app')
+@option('--interval', '-i', default=2.0, help='Seconds between refreshes')
+@option('--once', is_flag=True, help='Show the processes once and exit')
+def cmd_ps_top(app, interval, once):
+    """Show live process stats, e.g: piku ps:top <app> [-i <seconds>]"""
+
+    app = exit_if_invalid(app)
+
+    # a glob would also pick up apps whose names start with this one's followed by an underscore
+    sockets = [join(UWSGI_ROOT, '{}_{}.stats'.format(app, w)) for a, w in enabled_workers() if a == app]
+    if not any(exists(s) for s in sockets):
+        echo("Error: no stats sockets found for app '{}', redeploy it to enable them.".format(app), fg='red')
+        return
+
+    header = "{:<16} {:>8} {:<8} {:>9} {:>8} {:>9} {:>9}".format('process', 'pid', 'status', 'requests', 'avg ms', 'rss', 'queue')
+    row = "{:<16} {:>8} {:<8} {:>9} {:>8} {:>9} {:>9}"
+    with ThreadPool(len(sockets)) as pool:
+        try:
+            while True:
+                lines = []
+                for path, stats in zip(sockets, pool.map(read_worker_stats, sockets)):
+                    name = basename(path)[len(app) + 1:-len('.stats')]
+                    if stats is None:
+                        lines.append((row.format(name, '-', 'down', '-', '-', '-', '-'), 'red'))
+                        continue
+                    listen = (stats.get('sockets') or [{}])[0]
+                    queue = "{}/{}".format(listen.get('queue', stats.get('listen_queue', 0)), listen.get('max_queue', '-'))
+                    lines.append((row.format(name, stats.get('pid', '-'), 'master', '-', '-', human_size(process_rss(stats.get('pid', 0))), queue), 'green'))
+                    for w in stats.get('workers', []):
+                        lines.append((row.format('  worker {}'.format(w['id']), w['pid'], w['status'], w['requests'], "{:.1f}".format(w.get('avg_rt', 0) / 1000.0),
+                                                 human_size(w.get('rss') or process_rss(w['pid'])), ''), 'yellow' if w['status'] == 'busy' else 'white'))
+                    for d in stats.get('daemons', []):
+                        lines.append((row.format('  daemon', d['pid'], 'running' if d['pid'] else 'down', '-', '-', human_size(process_rss(d['pid'])) if d['pid'] else '-', ''),
+                                      'white' if d['pid'] else 'red'))
+                if not once:
+                    # home the cursor and clear the screen
+                    echo("\x1b[H\x1b[2J", nl=False)
+                echo("{}  {:%Y-%m-%d %H:%M:%S}".format(app, datetime.now()), fg='green')
+                echo(header, fg='green')
+                for line, colour in lines:
+                    echo(line, fg=colour)
+                if once:
+                    break
+                sleep(interval)
+        except KeyboardInterrupt:
+            pass
+
+
 @piku.command("ps:scale")
 @argument('app')
 @argument('settings', nargs=-1)
@@ -1660,6 +3974,55 @@ def cmd_ps_scale(app, settings):
     do_deploy(app, deltas)
 
 
+@piku.command("releases")
+@argument('app')
+def cmd_releases(app):
+    """List releases, e.g.: piku releases <app>"""
+
+    app = exit_if_invalid(app)
+
+    live = basename(realpath(join(APP_ROOT, app)))
+    history = release_history(app)
+    if not history:
+        echo("No releases found for app '{}'.".format(app), fg='yellow')
+        return
+    for name in dict.fromkeys(reversed(history)):
+        path = join(RELEASE_ROOT, app, name)
+        if not isdir(path):
+            continue
+        try:
+            info = check_output(['git', 'log', '-1', '--format=%ci %s'], cwd=path).decode('utf-8').strip()
+        except (CalledProcessError, OSError):
+            info = ''
+        echo("{} {} {}".format('*' if name == live else ' ', name, info), fg='green' if name == live else 'white')
+
+
+@piku.command("rollback")
+@argument('app')
+@argument('release', required=False)
+def cmd_rollback(app, release):
+    """Go back to the previous or a given release, e.g.: piku rollback <app> [<release>]"""
+
+    app = exit_if_invalid(app)
+
+    live = basename(realpath(join(APP_ROOT, app)))
+    if not release:
+        previous = [name for name in release_history(app) if name != live and isdir(join(RELEASE_ROOT, app, name))]
+        if not previous:
+            echo("Error: no previous release found for app '{}'.".format(app), fg='red')
+            return
+        release = previous[-1]
+    target = join(RELEASE_ROOT, app, sanitize_app_name(release))
+    if not isdir(target) or release in ['next', 'HISTORY']:
+        echo("Error: release '{}' not found for app '{}'.".format(release, app), fg='red')
+        return
+    echo("-----> Rolling back '{}' to release '{}'".format(app, release), fg='yellow')
+    # dependencies live outside releases, so only the code goes back
+    with release_lock(app):
+        activate_release(app, target)
+        spawn_app(app)
+
+
 @piku.command("run")
 @argument('app')
 @argument('cmd', nargs=-1)
@@ -1694,7 +4057,7 @@ def cmd_setup():
     echo("Running in Python {}".format(".".join(map(str, version_info))))
 
     # Create required paths
-    for p in [APP_ROOT, CACHE_ROOT, DATA_ROOT, GIT_ROOT, ENV_ROOT, UWSGI_ROOT, UWSGI_AVAILABLE, UWSGI_ENABLED, LOG_ROOT, NGINX_ROOT]:
+    for p in [APP_ROOT, RELEASE_ROOT, CACHE_ROOT, DATA_ROOT, GIT_ROOT, ENV_ROOT, UWSGI_ROOT, UWSGI_AVAILABLE, UWSGI_ENABLED, LOG_ROOT, NGINX_ROOT]:
         if not exists(p):
             echo("Creating '{}'.".format(p), fg='green')
             makedirs(p)
@@ -1718,6 +4081,13 @@ def cmd_setup():
         for k, v in settings:
             h.write("{k:s} = {v}\n".format(**locals()))
 
+    # piku-nginx.path units from older versions watch the whole nginx folder, reloading twice for every change
+    unit = '/etc/systemd/system/piku-nginx.path'
+    if exists(unit):
+        with open(unit, 'r') as h:
+            if NGINX_RELOAD not in h.read():
+                echo("Warning: '{}' is out of date, copy the current piku-nginx.path there and run 'systemctl daemon-reload' as root.".format(unit), fg='yellow')
+
     # mark this script as executable (in case we were invoked via interpreter)
     if not (stat(PIKU_SCRIPT).st_mode & S_IXUSR):
         echo("Setting '{}' as executable.".format(PIKU_SCRIPT), fg='yellow')
@@ -1766,21 +4136,18 @@ def cmd_git_hook(app):
     """INTERNAL: Post-receive git hook"""
 
     app = sanitize_app_name(app)
-    repo_path = join(GIT_ROOT, app)
     app_path = join(APP_ROOT, app)
     data_path = join(DATA_ROOT, app)
 
     for line in stdin:
         # pylint: disable=unused-variable
         oldrev, newrev, refname = line.strip().split(" ")
-        # Handle pushes
+        # Handle pushes (the first release is cloned from the repo by do_deploy)
         if not exists(app_path):
             echo("-----> Creating app '{}'".format(app), fg='green')
-            makedirs(app_path)
             # The data directory may already exist, since this may be a full redeployment (we never delete data since it may be expensive to recreate)
             if not exists(data_path):
                 makedirs(data_path)
-            call("git clone --quiet {} {}".format(repo_path, app), cwd=APP_ROOT, shell=True)
         do_deploy(app, newrev=newrev)
 
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+"""Micro-benchmark for nginx config rendering.
+
+Compares the precompiled template engine used by spawn_app against the
+regular expression passes it replaced, for apps with many NGINX_STATIC_PATHS.
+
+Usage: python3 tests/benchmarks/nginx_templates.py [repetitions]
+"""
+
+from os.path import abspath, dirname, join
+from sys import argv, path
+from timeit import timeit
+
+path.insert(0, abspath(join(dirname(__file__), '..', '..')))
+
+import piku  # noqa: E402
+
+# the tags are handled natively by the engine, so strip them for the regex passes
+TAGS = piku.re_compile(r'^[ \t]*\{%[^%\n]*%\}[ \t]*\n|\{%[^%\n]*%\}', piku.MULTILINE)
+
+
+def make_env(count):
+    env = {
+        'APP': 'bench',
+        'BIND_ADDRESS': '127.0.0.1',
+        'PORT': '5000',
+        'NGINX_SOCKET': '127.0.0.1:5000',
+        'NGINX_SERVER_NAME': 'bench.example.com',
+        'NGINX_IPV4_ADDRESS': '0.0.0.0',
+        'NGINX_IPV6_ADDRESS': '[::]',
+        'NGINX_SSL': '443 ssl',
+        'NGINX_HTTP2': 'http2 on;',
+        'NGINX_ROOT': piku.NGINX_ROOT,
+        'LOG_ROOT': piku.LOG_ROOT,
+        'ACME_WWW': piku.ACME_WWW,
+        'NGINX_ACL': '',
+        'DISABLE_IPV6': 'true',
+        'PIKU_INTERNAL_NGINX_UWSGI': 'false',
+        'PIKU_INTERNAL_NGINX_PROTOCOL': 'proxy',
+        'PIKU_INTERNAL_PROXY_CACHE_PATH': '',
+        'PIKU_INTERNAL_NGINX_CACHE_MAPPINGS': '',
+        'PIKU_INTERNAL_NGINX_CUSTOM_CLAUSES': '',
+        'PIKU_INTERNAL_NGINX_BLOCK_GIT': '',
+    }
+    profile = {'static_directio': '8m', 'static_sendfile_max_chunk': '1m', 'static_open_file_cache': 'max=1000 inactive=5m', 'static_open_file_cache_valid': '60s'}
+    statics = [dict(profile, static_url='/static{}'.format(i), static_path='/srv/bench/static{}/'.format(i), catch_all='') for i in range(count)]
+    return env, statics
+
+
+def render_legacy(env, statics):
+    env = dict(env)
+    static_mapping, portmap, common, template = [TAGS.sub('', t) for t in [
+        piku.PIKU_INTERNAL_NGINX_STATIC_MAPPING, piku.NGINX_PORTMAP_FRAGMENT, piku.NGINX_COMMON_FRAGMENT, piku.NGINX_TEMPLATE]]
+    env['PIKU_INTERNAL_NGINX_UWSGI_SETTINGS'] = 'proxy_pass http://{BIND_ADDRESS:s}:{PORT:s};'.format(**env)
+    env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] = ''
+    for values in statics:
+        env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] = env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] + piku.expandvars(static_mapping, values)
+    env['PIKU_INTERNAL_NGINX_PORTMAP'] = piku.expandvars(portmap, env)
+    env['PIKU_INTERNAL_NGINX_COMMON'] = piku.expandvars(common, env)
+    buffer = piku.expandvars(template, env)
+    buffer = '\n'.join([line for line in buffer.split('\n') if 'NGINX_IPV6' not in line])
+    buffer = buffer.replace("uwsgi_", "proxy_")
+    return buffer.replace("REMOTE_ADDR $remote_addr", "REMOTE_ADDR $http_cf_connecting_ip")
+
+
+def render_engine(env, statics):
+    env = dict(env)
+    env['PIKU_INTERNAL_NGINX_UWSGI_SETTINGS'] = piku.render_template(piku.PIKU_INTERNAL_NGINX_UWSGI_SETTINGS, env)
+    env['PIKU_INTERNAL_NGINX_STATIC_MAPPINGS'] = ''.join(piku.render_template(piku.PIKU_INTERNAL_NGINX_STATIC_MAPPING, values) for values in statics)
+    env['PIKU_INTERNAL_NGINX_PORTMAP'] = piku.render_template(piku.NGINX_PORTMAP_FRAGMENT, env)
+    env['PIKU_INTERNAL_NGINX_COMMON'] = piku.render_template(piku.NGINX_COMMON_FRAGMENT, env)
+    return piku.render_template(piku.NGINX_TEMPLATE, env)
+
+
+if __name__ == '__main__':
+    repetitions = int(argv[1]) if len(argv) > 1 else 200
+    print("{:>12} {:>14} {:>14} {:>9}".format('static paths', 'regex (ms)', 'engine (ms)', 'speedup'))
+    for count in [1, 10, 50, 200, 1000]:
+        env, statics = make_env(count)
+        legacy = timeit(lambda: render_legacy(env, statics), number=repetitions) / repetitions * 1000
+        engine = timeit(lambda: render_engine(env, statics), number=repetitions) / repetitions * 1000
+        print("{:>12} {:>14.3f} {:>14.3f} {:>8.1f}x".format(count, legacy, engine, legacy / engine))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""Checks that NGINX_CACHE_PURGE_ON_DEPLOY keys the nginx cache on the release being pushed.
+
+Pushes two revisions of a static app through the git hook and then changes a
+setting, each in a process of its own like the real commands, using a scratch
+piku home and a stub nginx. The cache key must follow the pushed revision and
+stay put on config:set.
+
+Usage: python3 tests/nginx/cache_key.py
+"""
+
+from os import chmod, environ, makedirs
+from os.path import abspath, dirname, join
+from re import search
+from subprocess import check_call, check_output, run
+from sys import executable, exit
+from tempfile import mkdtemp
+
+PIKU = abspath(join(dirname(__file__), '..', '..', 'piku.py'))
+
+# enough of `nginx -V` for get_nginx_ssl_config, and a successful `nginx -t`
+FAKE_NGINX = """#!/bin/sh
+echo "nginx version: nginx/1.24.0" >&2
+echo "configure arguments: --with-http_ssl_module --with-http_v2_module --with-http_gzip_static_module" >&2
+"""
+
+
+def piku(env, *args, stdin=None):
+    result = run([executable, PIKU] + list(args), env=env, input=stdin, capture_output=True, text=True)
+    if result.returncode:
+        print(result.stdout, result.stderr)
+        exit("piku {} failed".format(" ".join(args)))
+    return result.stdout
+
+
+def commit(src, message):
+    check_call(['git', 'add', '-A'], cwd=src)
+    check_call(['git', '-c', 'user.name=piku', '-c', 'user.email=piku@localhost', 'commit', '-q', '-m', message], cwd=src)
+    return check_output(['git', 'rev-parse', 'HEAD'], cwd=src).decode().strip()
+
+
+def push(env, home, src, oldrev, newrev):
+    check_call(['git', 'push', '-q', join(home, '.piku', 'repos', 'demo'), 'HEAD:refs/heads/master'], cwd=src)
+    piku(env, 'git-hook', 'demo', stdin="{} {} refs/heads/master\n".format(oldrev, newrev))
+
+
+def cache_key(home):
+    with open(join(home, '.piku', 'nginx', 'demo.conf')) as h:
+        return search(r'proxy_cache_key \$host\$request_uri:(\w+);', h.read()).group(1)
+
+
+def main():
+    home = mkdtemp(prefix='piku-cache-key-')
+    bin_path = join(home, 'bin')
+    makedirs(bin_path)
+    with open(join(bin_path, 'nginx'), 'w') as h:
+        h.write(FAKE_NGINX)
+    chmod(join(bin_path, 'nginx'), 0o755)
+    env = {**environ, 'HOME': home, 'USER': environ.get('USER', 'piku'), 'PATH': bin_path + ':' + environ['PATH']}
+    piku(env, 'setup')
+
+    src = join(home, 'src')
+    makedirs(join(src, 'public'))
+    with open(join(src, 'Procfile'), 'w') as h:
+        h.write("static: public\n")
+    with open(join(src, 'ENV'), 'w') as h:
+        h.write("NGINX_SERVER_NAME=demo.example.com\nNGINX_CACHE_PREFIXES=api\nNGINX_CACHE_PURGE_ON_DEPLOY=true\n")
+    with open(join(src, 'public', 'index.html'), 'w') as h:
+        h.write("first\n")
+    check_call(['git', 'init', '-q', src])
+    first = commit(src, 'first')
+    check_call(['git', 'init', '-q', '--bare', join(home, '.piku', 'repos', 'demo')])
+
+    push(env, home, src, '0' * 40, first)
+    failures = []
+    if cache_key(home) != first[:12]:
+        failures.append("first push keyed the cache on {} instead of {}".format(cache_key(home), first[:12]))
+
+    with open(join(src, 'public', 'index.html'), 'w') as h:
+        h.write("second\n")
+    second = commit(src, 'second')
+    push(env, home, src, first, second)
+    if cache_key(home) != second[:12]:
+        failures.append("second push kept the cache key {} instead of {}".format(cache_key(home), second[:12]))
+
+    piku(env, 'config:set', 'demo', 'FOO=bar')
+    if cache_key(home) != second[:12]:
+        failures.append("config:set changed the cache key to {}".format(cache_key(home)))
+
+    for failure in failures:
+        print("FAIL: {}".format(failure))
+    if failures:
+        exit(1)
+    print("OK: cache key follows pushes and survives config:set")
+
+
+if __name__ == '__main__':
+    main()
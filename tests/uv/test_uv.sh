@@ -228,7 +228,7 @@ else
 fi
 
 # ============================================
-section "Test 7: UV Sync Always Runs (UV handles its own caching)"
+section "Test 7: UV Sync Skipped When Dependencies Unchanged"
 # ============================================
 cleanup
 create_test_app
@@ -236,24 +236,21 @@ create_test_app
 # First deploy
 python3 $PIKU_SCRIPT deploy testapp >/dev/null 2>&1 || true
 
-# Second deploy - uv sync always runs but UV handles its own caching efficiently
+# Second deploy - pyproject.toml and the Python version did not change
 sleep 1
 output=$(python3 $PIKU_SCRIPT deploy testapp 2>&1) || true
 
-# UV should always be called - it handles its own caching internally
-if echo "$output" | grep -q "Running uv sync"; then
-    pass "uv sync runs (UV handles caching internally)"
+if echo "$output" | grep -q "skipping uv sync"; then
+    pass "uv sync skipped when dependencies are unchanged"
 else
-    fail "uv sync did not run"
+    fail "uv sync ran although dependencies did not change"
     echo "$output"
 fi
 
-# Verify UV's output shows it detected no changes (Audited instead of Installed)
-if echo "$output" | grep -q "Audited"; then
-    pass "UV detected no changes needed (Audited packages)"
+if "$ENV_DIR/bin/python" -c "import flask" 2>/dev/null; then
+    pass "Existing environment kept"
 else
-    # This is fine - UV might show different output
-    pass "UV ran successfully"
+    fail "Existing environment lost"
 fi
 
 # ============================================
@@ -467,13 +464,13 @@ else
     echo "$output"
 fi
 
-# Second deploy - UV handles caching
+# Second deploy - the regenerated uv.lock does not count as a dependency change
 sleep 1
 output=$(python3 $PIKU_SCRIPT deploy testapp 2>&1) || true
-if echo "$output" | grep -q "Running uv sync"; then
-    pass "uv sync runs on every deploy (UV caches internally)"
+if echo "$output" | grep -q "skipping uv sync"; then
+    pass "uv sync skipped although uv.lock was regenerated"
 else
-    fail "uv sync did not run"
+    fail "uv sync ran again because of the regenerated uv.lock"
     echo "$output"
 fi
 